@@ -0,0 +1,135 @@
+# coding: utf8
+"""Micro benchmarks, run as: python -m <app>.common.bench
+"""
+import sys
+import time
+import cPickle
+
+from ..common import field
+from ..common import model
+from ..common import record
+from ..common import session
+
+
+class _BenchModel(model.Model):
+    table = 'bench'
+    fields = {
+        'id': field.IntField(),
+        'user': field.CharField(maxlen=32),
+        'status': field.IntField(),
+        'ctime': field.DateTimeField(),
+    }
+
+
+def _data():
+    data = _BenchModel.data()
+    data.filter(user='alice', status__in=(1, 2, 3),
+                ctime__ge='2016-01-01 00:00:00')
+    return data.orderby('-ctime').limit(20, 40)
+
+
+def _query():
+    return _data()._gen_sql()
+
+
+def _rate(func, n):
+    begin = time.time()
+    for i in xrange(n):
+        func()
+    return n / (time.time() - begin)
+
+
+def bench_query_build(n=100000):
+    """Queries built per second with the SQL cache disabled and enabled,
+    for the whole ModelData chain and for the SQL generation alone.
+    """
+    data = _data()
+    maxsize = model.sql_cache.stats()['maxsize']
+    result = {}
+    try:
+        for name, size in (('uncached', 0), ('cached', maxsize or 1024)):
+            model.sql_cache.resize(size)
+            result[name] = _rate(_query, n)
+            result[name + '_sql'] = _rate(data._gen_sql, n)
+    finally:
+        model.sql_cache.resize(maxsize)
+    return result
+
+
+def bench_row_memory(n=10000):
+    """Bytes held per row by dict rows and record rows of the same
+    values, counting the containers only (values are shared).
+    """
+    names = tuple(sorted(_BenchModel.fields))
+    cls = record.record_class('_BenchModel', names)
+    values = (None, 1, 1, 'alice')
+    dicts = [dict(zip(names, values)) for i in xrange(n)]
+    records = [cls(values) for i in xrange(n)]
+    return {
+        'dict': sum([sys.getsizeof(row) for row in dicts]) / n,
+        'record': sum([sys.getsizeof(row) for row in records]) / n,
+    }
+
+
+def _session_data():
+    """Session of a logged in user with a cached permission map.
+    """
+    perms = {}
+    for i in xrange(200):
+        perms['module%d' % i] = {
+            'actions': ['read', 'write', 'export', 'audit'][:i % 4 + 1],
+            'scope': range(i % 10),
+            'granted': 1476748800.0 + i,
+        }
+    return {
+        'user': {'id': 1042, 'name': 'alice', 'email': 'alice@example.com'},
+        'perm': 3,
+        'perms': perms,
+        'login': 1476748800.0,
+    }
+
+
+class _Legacy(object):
+    """Protocol 0 pickles, the format before session.Serializer.
+    """
+    dumps = staticmethod(cPickle.dumps)
+    loads = staticmethod(cPickle.loads)
+
+
+def bench_session_codecs(n=1000):
+    """Encode and decode time in microseconds and stored bytes of a
+    session per serializer.
+    """
+    data = _session_data()
+    serializers = [('legacy', _Legacy())]
+    for codec in sorted(session._codecs):
+        serializers.append((codec, session.Serializer(codec, None)))
+        serializers.append((codec + '+zlib', session.Serializer(codec, 0)))
+    result = {}
+    for name, serializer in serializers:
+        value = serializer.dumps(data)
+        encode = _rate(lambda: serializer.dumps(data), n)
+        decode = _rate(lambda: serializer.loads(value), n)
+        result[name] = {
+            'encode': 1000000 / encode,
+            'decode': 1000000 / decode,
+            'bytes': len(value),
+        }
+    return result
+
+
+def main(argv):
+    result = bench_query_build()
+    print 'query build: %(uncached)d/s uncached, %(cached)d/s cached' % result
+    print 'sql only: %(uncached_sql)d/s uncached, %(cached_sql)d/s cached' % \
+        result
+    result = bench_row_memory()
+    print 'row memory: %(dict)d bytes dict, %(record)d bytes record' % result
+    result = bench_session_codecs()
+    for name, stat in sorted(result.items()):
+        print 'session %(name)-14s %(encode)7.1fus encode %(decode)7.1fus ' \
+            'decode %(bytes)7d bytes' % dict(stat, name=name)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,205 @@
+# coding: utf8
+import time
+import hashlib
+import cPickle
+import threading
+import collections
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from .. import config
+
+
+class CacheError(Exception):
+    pass
+
+
+class LruCache(object):
+    """In-process LRU whose entries expire ttl seconds after set.
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[0] < time.time():
+                self._misses = self._misses + 1
+                return None
+            self._items[key] = item
+            self._hits = self._hits + 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self._ttl
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + ttl, value)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._items),
+            'maxsize': self._maxsize,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+
+class RedisCache(object):
+    """Cache tier shared by processes through Redis.  Values are pickled,
+    Redis errors are counted and treated as misses.
+    """
+    def __init__(self, ttl=60, prefix='qc:', **redis_conf):
+        if redis is None:
+            raise CacheError('redis is not installed')
+        self._ttl = ttl
+        self._prefix = prefix
+        self._redis = redis.StrictRedis(**redis_conf)
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def get(self, key):
+        try:
+            value = self._redis.get(self._prefix + key)
+        except redis.RedisError:
+            self._errors = self._errors + 1
+            return None
+        if value is None:
+            self._misses = self._misses + 1
+            return None
+        self._hits = self._hits + 1
+        return cPickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self._ttl
+        try:
+            self._redis.setex(self._prefix + key, ttl,
+                              cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        except redis.RedisError:
+            self._errors = self._errors + 1
+
+    def versions(self, names):
+        """Return counters of names, 0 for missing ones.
+        """
+        try:
+            values = self._redis.mget([self._prefix + 'ver:' + name
+                                       for name in names])
+        except redis.RedisError:
+            self._errors = self._errors + 1
+            return None
+        return [int(value or 0) for value in values]
+
+    def incr(self, name):
+        try:
+            self._redis.incr(self._prefix + 'ver:' + name)
+        except redis.RedisError:
+            self._errors = self._errors + 1
+
+    def stats(self):
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'errors': self._errors,
+        }
+
+
+def _copy(rows):
+    """Copy dict rows, record rows are immutable already.
+    """
+    return [dict(row) if isinstance(row, dict) else row for row in rows]
+
+
+class QueryCache(object):
+    """Cache of query results keyed by SQL, arguments and the versions of
+    the tables it reads.  invalidate(table) bumps the table version, so
+    entries read before the write are never served again.
+    With a Redis tier the versions live in Redis and writes of other
+    processes are seen at once by the Redis tier; the local tier only
+    sees its own process' writes and relies on its ttl for the others.
+    @param maxsize: entries of the local tier
+    @param ttl: seconds an entry lives, in both tiers
+    @param redis_conf: kwargs of redis.StrictRedis to enable the Redis tier
+    """
+    def __init__(self, maxsize=1024, ttl=60, redis_conf=None, prefix='qc:'):
+        self._ttl = ttl
+        self._local = LruCache(maxsize, ttl)
+        self._remote = None
+        if redis_conf is not None:
+            self._remote = RedisCache(ttl, prefix, **redis_conf)
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._invalidations = 0
+
+    def versions(self, tables):
+        """Versions of tables in this process, they change on every
+        invalidate.
+        """
+        return tuple([self._versions.get(table, 0) for table in tables])
+
+    def fetch(self, tables, sql, args, envs, load):
+        """Return cached rows of sql, or rows of load(sql, args, envs)
+        after caching them.  Dict rows are copied on the way out so
+        callers cannot change the cached ones.
+        """
+        query = repr((sql, tuple(args), sorted((envs or {}).items())))
+        local_key = (self.versions(tables), query)
+        rows = self._local.get(local_key)
+        if rows is not None:
+            return _copy(rows)
+        remote_key = None
+        if self._remote is not None:
+            versions = self._remote.versions(tables)
+            if versions is not None:
+                remote_key = hashlib.sha1(repr(versions) + query).hexdigest()
+                rows = self._remote.get(remote_key)
+                if rows is not None:
+                    self._local.set(local_key, rows)
+                    return _copy(rows)
+        rows = load(sql, args, envs)
+        self._local.set(local_key, rows)
+        if remote_key is not None:
+            self._remote.set(remote_key, rows)
+        return _copy(rows)
+
+    def invalidate(self, table):
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            self._invalidations = self._invalidations + 1
+        if self._remote is not None:
+            self._remote.incr(table)
+
+    def clear(self):
+        self._local.clear()
+
+    def stats(self):
+        stats = {
+            'local': self._local.stats(),
+            'invalidations': self._invalidations,
+        }
+        if self._remote is not None:
+            stats['redis'] = self._remote.stats()
+        return stats
+
+
+query_cache = QueryCache(**getattr(config, 'query_cache', {}))
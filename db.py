@@ -1,10 +1,17 @@
 # coding: utf8
+import sys
+import time
+import Queue
+import random
+import itertools
 import functools
+import threading
 
 import MySQLdb
-from MySQLdb.cursors import DictCursor
+from MySQLdb.cursors import Cursor, DictCursor, SSCursor, SSDictCursor
 
 from .. import config
+from ..common import dbstats
 
 
 class DbError(Exception):
@@ -19,28 +26,63 @@ class CommitError(DbError):
     pass
 
 
-class DbConnection():
-    def __init__(self):
+class PoolTimeoutError(OpenError):
+    pass
+
+
+# MySQL client errors of a lost or refused connection
+_conn_errors = (2002, 2003, 2006, 2013)
+
+
+class DbConnection(object):
+    """One MySQLdb connection owned by a ConnectionPool.
+    While checked out it belongs to a single thread, which keeps the
+    nesting count of _Connection and the transaction counter here.
+    A connection marked broken is dropped instead of going back idle.
+    """
+    def __init__(self, params, connect=None):
+        self._params = params
+        self._connect = connect or MySQLdb.connect
         self._connection = None
         self._connections = 0
         self._transactions = 0
+        # (func, args) called when the transaction ends
+        self._after = []
+        self.broken = False
+        self.last_used = time.time()
+        # pool wait of the current checkout, charged to its first statement
+        self.wait = 0.0
+
+    def connect(self):
+        try:
+            self._connection = self._connect(**self._params)
+        except MySQLdb.DatabaseError:
+            raise OpenError()
+        self._connection.autocommit(True)
+        self.last_used = time.time()
+
+    def ping(self):
+        try:
+            self._connection.ping()
+        except MySQLdb.Error:
+            return False
+        return True
+
+    def disconnect(self):
+        try:
+            self._connection.close()
+        except MySQLdb.Error:
+            pass
 
     def open(self):
-        if self._connections == 0:
-            try:
-                self._connection = MySQLdb.connect(**config.mysqldb)
-            except MySQLdb.DatabaseError:
-                raise OpenError()
-            self._connection.autocommit(True)
         self._connections = self._connections + 1
 
     def close(self):
         self._connections = self._connections - 1
-        if self._connections == 0:
-            self._connection.close()
+        return self._connections == 0
 
-    def open_cursor(self):
-        return self._connection.cursor(DictCursor)
+    def open_cursor(self, cursorclass=DictCursor):
+        return self._connection.cursor(cursorclass)
 
     def inc_trans(self):
         if self._transactions == 0:
@@ -51,12 +93,21 @@ class DbConnection():
         self._transactions = self._transactions - 1
         if self._transactions == 0:
             self._connection.autocommit(True)
+            after, self._after = self._after, []
+            for func, args in after:
+                func(*args)
+
+    def after_trans(self, func, *args):
+        self._after.append((func, args))
+
+    def in_trans(self):
+        return self._transactions > 0
 
     def commit(self):
         try:
             self._connection.commit()
-        except MySQLdb.DatabaseError:
-            raise CommitError()
+        except MySQLdb.DatabaseError, e:
+            raise CommitError(*e.args)
 
     def rollback(self):
         try:
@@ -67,8 +118,456 @@ class DbConnection():
     def insert_id(self):
         return self._connection.insert_id()
 
+    def literal(self, val):
+        return self._connection.literal(val)
+
+
+class ConnectionPool(object):
+    """Bounded pool of DbConnection.
+    A thread checks out one connection at its outermost _Connection and
+    keeps it for all nested ones, so a transaction never spans two
+    connections and two threads never share one.
+    @param params: kwargs of MySQLdb.connect
+    @param connect: stand-in for MySQLdb.connect, in tests
+    @param size: max connections, in use and idle
+    @param timeout: seconds to wait for a free connection, None for ever
+    @param nested_timeout: seconds at most a thread already holding a
+                           connection waits for another one, e.g. for
+                           iter_select, so threads holding all of them
+                           cannot wait for each other for ever
+    @param max_idle: idle connections older than this are closed
+    @param ping_interval: ping a connection on checkout when it has
+                          been idle longer than this
+    """
+    def __init__(self, params, size=10, timeout=None, max_idle=300,
+                 ping_interval=30, connect=None, nested_timeout=5):
+        self._params = params
+        self._connect = connect
+        self._size = size
+        self._timeout = timeout
+        self._nested_timeout = nested_timeout
+        self._max_idle = max_idle
+        self._ping_interval = ping_interval
+        self._local = threading.local()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._total = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._reaped = 0
+
+    def _reap(self, now):
+        """Pop connections idle longer than max_idle.  Called with the
+        lock held, the caller disconnects them after releasing it.
+        """
+        expired = [conn for conn in self._idle
+                   if now - conn.last_used > self._max_idle]
+        if expired:
+            self._idle = [conn for conn in self._idle
+                          if now - conn.last_used <= self._max_idle]
+            self._total = self._total - len(expired)
+            self._reaped = self._reaped + len(expired)
+        return expired
+
+    def _checkout(self):
+        begin = time.time()
+        timeout = self._timeout
+        if self.holding() and (timeout is None or
+                               timeout > self._nested_timeout):
+            timeout = self._nested_timeout
+        waited = False
+        expired = []
+        self._cond.acquire()
+        try:
+            while True:
+                expired.extend(self._reap(time.time()))
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._total < self._size:
+                    conn = None
+                    self._total = self._total + 1
+                    break
+                if timeout is not None:
+                    remain = timeout - (time.time() - begin)
+                    if remain <= 0:
+                        self._timeouts = self._timeouts + 1
+                        raise PoolTimeoutError()
+                else:
+                    remain = None
+                waited = True
+                self._waiting = self._waiting + 1
+                try:
+                    self._cond.wait(remain)
+                finally:
+                    self._waiting = self._waiting - 1
+            self._in_use = self._in_use + 1
+            self._checkouts = self._checkouts + 1
+            wait_time = 0.0
+            if waited:
+                wait_time = time.time() - begin
+                self._waits = self._waits + 1
+                self._wait_time = self._wait_time + wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+        finally:
+            self._cond.release()
+            for old in expired:
+                old.disconnect()
+        if conn is not None and \
+                time.time() - conn.last_used > self._ping_interval and \
+                not conn.ping():
+            conn.disconnect()
+            conn = None
+        if conn is None:
+            conn = DbConnection(self._params, self._connect)
+            try:
+                conn.connect()
+            except OpenError:
+                self._discard()
+                raise
+        conn.wait = wait_time
+        return conn
+
+    def _discard(self):
+        self._cond.acquire()
+        try:
+            self._total = self._total - 1
+            self._in_use = self._in_use - 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _checkin(self, conn):
+        if conn.broken:
+            conn.disconnect()
+            self._discard()
+            return
+        if conn.in_trans():
+            # leaked transaction, never hand it to another thread
+            conn.rollback()
+            conn.disconnect()
+            self._discard()
+            return
+        conn.last_used = time.time()
+        self._cond.acquire()
+        try:
+            self._in_use = self._in_use - 1
+            self._idle.append(conn)
+            expired = self._reap(conn.last_used)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        for old in expired:
+            old.disconnect()
+
+    def acquire(self):
+        """Open a (nested) connection for the current thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._checkout()
+            self._local.conn = conn
+        conn.open()
+        return conn
+
+    def release(self):
+        """Close a (nested) connection of the current thread, and give
+        it back to the pool when the outermost one closes.
+        """
+        conn = self._local.conn
+        if conn.close():
+            self._local.conn = None
+            self._checkin(conn)
+
+    def holding(self):
+        """Whether the current thread has a connection open, or one of
+        iter_select.
+        """
+        return getattr(self._local, 'conn', None) is not None or \
+            getattr(self._local, 'streams', 0) > 0
+
+    def _stream(self, step):
+        """Count the connections of iter_select the current thread
+        holds, they are checked out without acquire.
+        """
+        self._local.streams = getattr(self._local, 'streams', 0) + step
+
+    def current(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            raise DbError('no connection opened in this thread')
+        return conn
+
+    def reap(self):
+        """Close idle connections older than max_idle.  Checkout and
+        checkin do it already, call it from a timer if the pool may
+        stay untouched for long.
+        """
+        self._cond.acquire()
+        try:
+            expired = self._reap(time.time())
+        finally:
+            self._cond.release()
+        for old in expired:
+            old.disconnect()
+        return len(expired)
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return {
+                'size': self._size,
+                'total': self._total,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'timeouts': self._timeouts,
+                'reaped': self._reaped,
+            }
+        finally:
+            self._cond.release()
+
+
+_pool = ConnectionPool(config.mysqldb, **getattr(config, 'mysqldb_pool', {}))
+
+
+def _conn():
+    return _pool.current()
+
+
+def pool_stats():
+    return _pool.stats()
+
 
-_db_conn = DbConnection()
+def in_transaction():
+    conn = getattr(_pool._local, 'conn', None)
+    return conn is not None and conn.in_trans()
+
+
+def after_transaction(func, *args):
+    """Call func(*args) when the transaction of this thread ends,
+    committed or rolled back, or at once outside of a transaction.
+    """
+    conn = getattr(_pool._local, 'conn', None)
+    if conn is not None and conn.in_trans():
+        conn.after_trans(func, *args)
+    else:
+        func(*args)
+
+
+class Replica(object):
+    """A read replica with its own ConnectionPool.
+    """
+    def __init__(self, params, weight=1, pool_conf=None):
+        self.pool = ConnectionPool(params, **(pool_conf or {}))
+        self.weight = weight
+        self.down_until = 0
+        self.lag_checked = 0
+        self.reads = 0
+        self.ejections = 0
+
+    def lag(self):
+        """Seconds behind the primary, None if replication is broken.
+        """
+        conn = self.pool._checkout()
+        cursor = None
+        try:
+            cursor = conn.open_cursor()
+            _execute(conn, cursor, 'SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+        finally:
+            if cursor:
+                cursor.close()
+            self.pool._checkin(conn)
+        if not row:
+            return 0
+        return row['Seconds_Behind_Master']
+
+
+class ReplicaRouter(object):
+    """Choose the replica a read goes to.  Reads stay on the primary
+    inside a transaction, for FOR UPDATE/LOCK IN SHARE MODE, and after a
+    write of the thread until end_request().  Replicas whose connection
+    fails, or which lag more than max_lag, are ejected for eject_time.
+    @param replicas: list of Replica
+    @param policy: 'weight' for weighted random, 'round_robin'
+    @param max_lag: seconds, None to skip lag checks
+    @param lag_interval: seconds between lag checks of a replica
+    """
+    def __init__(self, replicas, policy='weight', eject_time=30,
+                 max_lag=None, lag_interval=10):
+        self.replicas = replicas
+        self._policy = policy
+        self._eject_time = eject_time
+        self._max_lag = max_lag
+        self._lag_interval = lag_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._primary_reads = 0
+
+    def _pick(self, live):
+        if self._policy == 'round_robin':
+            return live[next(self._turn) % len(live)]
+        point = random.uniform(0, sum([rep.weight for rep in live]))
+        for rep in live:
+            point = point - rep.weight
+            if point <= 0:
+                return rep
+        return live[-1]
+
+    def _lagging(self, replica, now):
+        if self._max_lag is None:
+            return False
+        with self._lock:
+            if now - replica.lag_checked < self._lag_interval:
+                return False
+            replica.lag_checked = now
+        try:
+            lag = replica.lag()
+        except (DbError, MySQLdb.Error):
+            return True
+        return lag is None or lag > self._max_lag
+
+    def choose(self, sql):
+        """Return the Replica to read sql from, None for the primary.
+        """
+        if not self.replicas or getattr(self._local, 'wrote', False) or \
+                in_transaction() or 'FOR UPDATE' in sql or \
+                'LOCK IN SHARE MODE' in sql:
+            self._primary_reads = self._primary_reads + 1
+            return None
+        now = time.time()
+        live = [rep for rep in self.replicas if rep.down_until <= now]
+        while live:
+            replica = self._pick(live)
+            if not self._lagging(replica, now):
+                replica.reads = replica.reads + 1
+                return replica
+            self.eject(replica)
+            live.remove(replica)
+        self._primary_reads = self._primary_reads + 1
+        return None
+
+    def eject(self, replica):
+        replica.down_until = time.time() + self._eject_time
+        replica.ejections = replica.ejections + 1
+
+    def wrote(self):
+        self._local.wrote = True
+
+    def end_request(self):
+        self._local.wrote = False
+
+    def stats(self):
+        now = time.time()
+        return {
+            'primary_reads': self._primary_reads,
+            'replicas': [{
+                'host': rep.pool._params.get('host'),
+                'up': rep.down_until <= now,
+                'reads': rep.reads,
+                'ejections': rep.ejections,
+                'pool': rep.pool.stats(),
+            } for rep in self.replicas],
+        }
+
+
+def set_replicas(replicas, **kv):
+    """Route reads to replicas, a list of MySQLdb.connect kwargs with
+    an optional 'weight'.  kv goes to ReplicaRouter.
+    """
+    global _router
+    pool_conf = getattr(config, 'mysqldb_pool', {})
+    reps = []
+    for params in replicas:
+        params = dict(params)
+        weight = params.pop('weight', 1)
+        reps.append(Replica(params, weight, pool_conf))
+    _router = ReplicaRouter(reps, **kv)
+
+
+_router = None
+set_replicas(getattr(config, 'mysqldb_replicas', []),
+             **getattr(config, 'mysqldb_routing', {}))
+
+
+def end_request():
+    """Let reads go to replicas again after a write, call it when a
+    request ends.
+    """
+    _router.end_request()
+
+
+def routing_stats():
+    return _router.stats()
+
+
+def _lost(e):
+    return bool(e.args) and e.args[0] in _conn_errors
+
+
+def _read(func, sql, *args):
+    """Return func(conn, sql, *args) run on a connection of the replica
+    chosen for sql, or of the primary.  A replica which cannot be
+    reached is ejected, its connection dropped, and the read is run
+    again on the primary.  Other errors of the query are raised.
+    """
+    replica = _router.choose(sql)
+    if replica is not None:
+        try:
+            conn = replica.pool.acquire()
+            try:
+                return func(conn, sql, *args)
+            except MySQLdb.OperationalError, e:
+                if _lost(e):
+                    conn.broken = True
+                raise
+            finally:
+                replica.pool.release()
+        except PoolTimeoutError:
+            # the replica is busy, not down
+            pass
+        except OpenError:
+            _router.eject(replica)
+        except MySQLdb.OperationalError, e:
+            if not _lost(e):
+                raise
+            _router.eject(replica)
+    with _Connection():
+        return func(_conn(), sql, *args)
+
+
+def _execute(conn, cursor, sql, args=None, shape=None):
+    """Execute sql on cursor of conn and record it in
+    dbstats.statement_stats under shape, sql by default.
+    """
+    begin = time.time()
+    try:
+        return cursor.execute(sql, args)
+    finally:
+        wait, conn.wait = conn.wait, 0.0
+        dbstats.statement_stats.record(shape or sql, time.time() - begin,
+                                       cursor.rowcount, wait)
+
+
+def _set_envs(conn, cursor, envs):
+    if envs:
+        for item in envs.items():
+            _execute(conn, cursor, 'SET @%s:=%s', item)
+
+
+def statement_stats():
+    return dbstats.statement_stats.stats()
 
 
 class _Connection(object):
@@ -76,11 +575,11 @@ class _Connection(object):
     and close connection in __exit__
     """
     def __enter__(self):
-        _db_conn.open()
+        _pool.acquire()
         return self
 
     def __exit__(self, exctype, excvalue, exctraceback):
-        _db_conn.close()
+        _pool.release()
 
 
 def with_connection(func):
@@ -102,7 +601,7 @@ class _Transaction(object):
     def __enter__(self):
         """Enter the content, transaction begins.
         """
-        _db_conn.inc_trans()
+        _conn().inc_trans()
         return self
 
     def __exit__(self, exctype, excvalue, exctraceback):
@@ -113,18 +612,78 @@ class _Transaction(object):
         """
         try:
             if exctype:
-                _db_conn.rollback()
+                _conn().rollback()
             else:
-                _db_conn.commit()
+                _conn().commit()
         finally:
-            _db_conn.dec_trans()
+            _conn().dec_trans()
 
 
-def with_transaction(func):
-    """Decorator for _Transaction
+class RetryPolicy(object):
+    """Run a transaction again when it fails with a retryable MySQL
+    error, deadlock (1213) and lock wait timeout (1205) by default.
+    The n-th retry sleeps a random time up to backoff * 2**n, at most
+    max_backoff.
+    @param attempts: runs in all, the first one included
+    """
+    def __init__(self, attempts=3, backoff=0.05, max_backoff=1.0,
+                 codes=(1213, 1205)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.codes = codes
+        self._lock = threading.Lock()
+        self._retries = 0
+        self._giveups = 0
+
+    def retryable(self, exc):
+        return isinstance(exc, (MySQLdb.OperationalError, CommitError)) and \
+            bool(exc.args) and exc.args[0] in self.codes
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def run(self, func, *args, **kv):
+        attempt = 1
+        while True:
+            try:
+                with _Connection():
+                    with _Transaction():
+                        return func(*args, **kv)
+            except Exception, e:
+                if not self.retryable(e):
+                    raise
+                with self._lock:
+                    if attempt >= self.attempts:
+                        self._giveups = self._giveups + 1
+                        raise
+                    self._retries = self._retries + 1
+            time.sleep(self.delay(attempt))
+            attempt = attempt + 1
+
+    def stats(self):
+        return {'retries': self._retries, 'giveups': self._giveups}
+
+
+retry_policy = RetryPolicy(**getattr(config, 'mysqldb_retry', {}))
+
+
+def with_transaction(func=None, retry=None):
+    """Decorator for _Transaction.
+    @with_transaction(retry=True) runs the function again on deadlock
+    with retry_policy, or with the RetryPolicy given.  Only the
+    outermost transaction retries, as MySQL rolls back all of it.
     """
+    if func is None:
+        return functools.partial(with_transaction, retry=retry)
+    if retry is True:
+        retry = retry_policy
+
     @functools.wraps(func)
     def wrapper(*args, **kv):
+        if retry and not in_transaction():
+            return retry.run(func, *args, **kv)
         with _Connection():
             with _Transaction():
                 return func(*args, **kv)
@@ -133,32 +692,102 @@ def with_transaction(func):
 
 @with_connection
 def insert(table, **kv):
+    _router.wrote()
     cols, args = zip(*kv.iteritems())
     colstr = ','.join(['`'+col+'`' for col in cols])
     argstr = ','.join(['%s'] * len(args))
     sql = 'INSERT INTO `%s`(%s) VALUES (%s)' % (table, colstr, argstr)
+    conn = _conn()
     cursor = None
     try:
-        cursor = _db_conn.open_cursor()
-        cursor.execute(sql, args)
+        cursor = conn.open_cursor()
+        _execute(conn, cursor, sql, args)
         return True
     finally:
         if cursor:
             cursor.close()
 
 
+def _insert_chunk(head, values, tail):
+    conn = _conn()
+    cursor = None
+    try:
+        cursor = conn.open_cursor()
+        return _execute(conn, cursor, head + ','.join(values) + tail,
+                        shape=head + '...' + tail)
+    finally:
+        if cursor:
+            cursor.close()
+
+
+@with_connection
+def insert_many(table, rows, max_bytes=None, update=None):
+    """Insert rows with multi-row INSERT statements.
+    Rows are split into statements no longer than max_bytes, each one
+    runs in its own transaction unless a transaction is already open.
+    @param rows: list of dict, all with the same keys
+    @param max_bytes: statement size limit, config.mysqldb_max_packet
+                      or 1MB by default
+    @param update: ON DUPLICATE KEY UPDATE the given columns, True for
+                   all columns
+    @return affected rows
+    """
+    if not rows:
+        return 0
+    _router.wrote()
+    if max_bytes is None:
+        max_bytes = getattr(config, 'mysqldb_max_packet', 1024 * 1024)
+    cols = rows[0].keys()
+    colstr = ','.join(['`'+col+'`' for col in cols])
+    head = 'INSERT INTO `%s`(%s) VALUES ' % (table, colstr)
+    tail = ''
+    if update:
+        if update is True:
+            update = cols
+        tail = ' ON DUPLICATE KEY UPDATE ' + \
+               ','.join([('`%s`=VALUES(`%s`)' % (col, col)) for col in update])
+    literal = _conn().literal
+    chunks = []
+    values = []
+    size = len(head) + len(tail)
+    for row in rows:
+        if len(row) != len(cols):
+            raise DbError('rows have different columns')
+        try:
+            valstr = '(%s)' % ','.join([literal(row[col]) for col in cols])
+        except KeyError:
+            raise DbError('rows have different columns')
+        if values and size + len(valstr) + 1 > max_bytes:
+            chunks.append(values)
+            values = []
+            size = len(head) + len(tail)
+        values.append(valstr)
+        size = size + len(valstr) + 1
+    chunks.append(values)
+    affected = 0
+    for values in chunks:
+        if _conn().in_trans():
+            affected = affected + _insert_chunk(head, values, tail)
+        else:
+            with _Transaction():
+                affected = affected + _insert_chunk(head, values, tail)
+    return affected
+
+
 @with_connection
 def update(table, where=None, *where_args, **kv):
+    _router.wrote()
     cols, args = zip(*kv.iteritems())
     updatestr = ','.join([('`%s`=%%s' % col) for col in cols])
     if where:
         sql = 'UPDATE `%s` SET %s where %s' % (table, updatestr, where)
     else:
         sql = 'UPDATE `%s` SET %s' % (table, updatestr)
+    conn = _conn()
     cursor = None
     try:
-        cursor = _db_conn.open_cursor()
-        cursor.execute(sql, args + where_args)
+        cursor = conn.open_cursor()
+        _execute(conn, cursor, sql, args + where_args)
         return True
     finally:
         if cursor:
@@ -167,57 +796,215 @@ def update(table, where=None, *where_args, **kv):
 
 @with_connection
 def delete(sql, args):
+    _router.wrote()
+    conn = _conn()
     cursor = None
     try:
-        cursor = _db_conn.open_cursor()
-        return cursor.execute(sql, args)
+        cursor = conn.open_cursor()
+        return _execute(conn, cursor, sql, args)
     finally:
         if cursor:
             cursor.close()
 
 
 @with_connection
-def select(sql, args, envs = None):
+def execute(sql, args=None):
+    """Run a statement on the primary, e.g. DDL, return its row count.
+    """
+    _router.wrote()
+    conn = _conn()
     cursor = None
     try:
-        cursor = _db_conn.open_cursor()
-        if envs:
-            for item in envs.items():
-                cursor.execute('SET @%s:=%s', item)
-        cursor.execute(sql, args)
+        cursor = conn.open_cursor()
+        return _execute(conn, cursor, sql, args)
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def execute_apart(sql, args=None):
+    """Same as execute, but on a pooled connection of its own, so DDL
+    does not commit the transaction of the current thread.
+    """
+    _router.wrote()
+    conn = _pool._checkout()
+    cursor = None
+    try:
+        cursor = conn.open_cursor()
+        return _execute(conn, cursor, sql, args)
+    finally:
+        if cursor:
+            cursor.close()
+        _pool._checkin(conn)
+
+
+def _select(conn, sql, args, envs):
+    cursor = None
+    try:
+        cursor = conn.open_cursor()
+        _set_envs(conn, cursor, envs)
+        _execute(conn, cursor, sql, args)
         return cursor.fetchall()
     finally:
         if cursor:
             cursor.close()
 
 
-@with_connection
-def select_one(sql, args):
+def select(sql, args, envs = None):
+    return _read(_select, sql, args, envs)
+
+
+def iter_select(sql, args, batch=1000, envs=None, cursorclass=SSDictCursor):
+    """Yield rows of sql one by one from a server-side cursor, keeping
+    at most batch rows in memory.  Pass cursorclass=SSCursor for tuple
+    rows.
+    The cursor runs on a connection of its own, so other queries can
+    be made while iterating, but it does not see uncommitted changes of
+    the current transaction.  Those queries need another connection of
+    the pool and wait nested_timeout at most for it.  If the iteration
+    stops early the connection is dropped rather than draining the
+    remaining rows.
+    """
+    replica = _router.choose(sql)
+    pool = replica.pool if replica is not None else _pool
+    try:
+        conn = pool._checkout()
+    except OpenError:
+        if replica is None:
+            raise
+        _router.eject(replica)
+        pool = _pool
+        conn = pool._checkout()
+    pool._stream(1)
     cursor = None
+    finished = False
+    # rowcount is unknown on server-side cursors, the statement is
+    # recorded once its rows are fetched, with the time spent in MySQL
+    elapsed = 0.0
+    count = 0
+    wait = 0.0
     try:
-        cursor = _db_conn.open_cursor()
-        cursor.execute(sql, args)
-        return cursor.fetchone()
+        cursor = conn.open_cursor(cursorclass)
+        _set_envs(conn, cursor, envs)
+        wait, conn.wait = conn.wait, 0.0
+        begin = time.time()
+        try:
+            cursor.execute(sql, args)
+        finally:
+            elapsed = time.time() - begin
+        while True:
+            begin = time.time()
+            rows = cursor.fetchmany(batch)
+            elapsed = elapsed + time.time() - begin
+            if not rows:
+                break
+            count = count + len(rows)
+            for row in rows:
+                yield row
+        finished = True
     finally:
+        pool._stream(-1)
         if cursor:
+            dbstats.statement_stats.record(sql, elapsed, count, wait)
+        if finished:
             cursor.close()
+            pool._checkin(conn)
+        else:
+            conn.disconnect()
+            pool._discard()
 
 
-@with_connection
-def count(table, where=None, *where_args):
-    if where:
-        sql = 'SELECT COUNT(*) FROM %s where %s' % (table, where)
-    else:
-        sql = 'SELECT COUNT(*) FROM %s' % (table)
+def _select_tuples(conn, sql, args, envs):
     cursor = None
     try:
-        cursor = _db_conn.open_cursor()
-        cursor.execute(sql, where_args)
-        return True
+        cursor = conn.open_cursor(Cursor)
+        _set_envs(conn, cursor, envs)
+        _execute(conn, cursor, sql, args)
+        rows = cursor.fetchall()
+        return tuple([desc[0] for desc in cursor.description]), rows
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def select_tuples(sql, args, envs=None):
+    """Same as select, but rows are tuples.
+    @return (column names, rows)
+    """
+    return _read(_select_tuples, sql, args, envs)
+
+
+def select_parallel(queries, workers=None, func=None):
+    """Run func(sql, args, envs), select by default, for each query of
+    queries on up to workers threads, each with its own pooled
+    connection.
+    Queries run one after the other on the caller's connection when it
+    has one open, so that callers cannot take the whole pool and wait
+    for each other.
+    @param workers: config.mysqldb_workers or 4 by default
+    @return results in the order of queries
+    """
+    if func is None:
+        func = select
+    if workers is None:
+        workers = getattr(config, 'mysqldb_workers', 4)
+    if _pool.holding():
+        workers = 1
+    results = [None] * len(queries)
+    errors = []
+    todo = Queue.Queue()
+    for i in range(len(queries)):
+        todo.put(i)
+    # workers read from the primary too when the caller has written
+    wrote = getattr(_router._local, 'wrote', False)
+
+    def work():
+        if wrote:
+            _router.wrote()
+        while not errors:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(*queries[i])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(queries)) - 1)]
+    for thread in threads:
+        thread.start()
+    work()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def _select_one(conn, sql, args):
+    cursor = None
+    try:
+        cursor = conn.open_cursor()
+        _execute(conn, cursor, sql, args)
+        return cursor.fetchone()
     finally:
         if cursor:
             cursor.close()
 
 
+def select_one(sql, args):
+    return _read(_select_one, sql, args)
+
+
+def count(table, where=None, *where_args):
+    if where:
+        sql = 'SELECT COUNT(*) FROM `%s` where %s' % (table, where)
+    else:
+        sql = 'SELECT COUNT(*) FROM `%s`' % (table)
+    return select_one(sql, where_args)['COUNT(*)']
+
+
 def insert_id():
-    return _db_conn.insert_id()
+    return _conn().insert_id()
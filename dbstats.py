@@ -0,0 +1,161 @@
+# coding: utf8
+import os
+import sys
+import json
+import bisect
+import signal
+import logging
+import threading
+
+from .. import config
+
+
+# upper bounds of histogram buckets in seconds, from 0.1ms to ~100s,
+# each a quarter power of two above the previous one
+_bounds = [0.0001 * 2 ** (i / 4.0) for i in range(81)]
+_pkgdir = os.path.dirname(os.path.abspath(__file__))
+_slowlog = logging.getLogger(__name__ + '.slow')
+
+
+class Histogram(object):
+    """Fixed log-scale histogram, percentiles are bucket upper bounds.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, val):
+        self.counts[bisect.bisect_left(_bounds, val)] += 1
+        self.count = self.count + 1
+        self.total = self.total + val
+        if val > self.max:
+            self.max = val
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, cnt in enumerate(self.counts):
+            seen = seen + cnt
+            if seen >= rank:
+                break
+        if i < len(_bounds):
+            return min(_bounds[i], self.max)
+        return self.max
+
+
+class _Shape(object):
+    def __init__(self):
+        self.time = Histogram()
+        self.rows = 0
+        self.wait = 0.0
+        self.slow = 0
+
+
+def _origin():
+    """Return (model name, call site) of the statement being run: the
+    Model found in the applib frames and the first frame outside of it.
+    """
+    model = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not os.path.abspath(filename).startswith(_pkgdir):
+            return model, '%s:%d %s' % (filename, frame.f_lineno,
+                                        frame.f_code.co_name)
+        if model is None:
+            obj = frame.f_locals.get('self', frame.f_locals.get('cls'))
+            obj = getattr(obj, '_model', obj)
+            if hasattr(obj, 'table') and hasattr(obj, 'fields'):
+                model = getattr(obj, '__name__', None)
+        frame = frame.f_back
+    return model, None
+
+
+class StatementStats(object):
+    """Wall time, rows and pool wait per statement shape, with a slow
+    query log.  The shape is the SQL text before arguments are bound.
+    @param slow: seconds above which statements are logged, None for no
+                 log
+    @param maxshapes: shapes kept, others are counted under '<other>'
+    """
+    def __init__(self, slow=1.0, maxshapes=1000):
+        self.slow = slow
+        self._maxshapes = maxshapes
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, shape, elapsed, rows, wait):
+        slow = self.slow is not None and elapsed >= self.slow
+        with self._lock:
+            stat = self._shapes.get(shape)
+            if stat is None:
+                key = shape
+                if len(self._shapes) >= self._maxshapes:
+                    key = '<other>'
+                stat = self._shapes.setdefault(key, _Shape())
+            stat.time.add(elapsed)
+            stat.rows = stat.rows + max(rows, 0)
+            stat.wait = stat.wait + wait
+            if slow:
+                stat.slow = stat.slow + 1
+        if slow:
+            model, site = _origin()
+            _slowlog.warning('slow query %.3fs rows=%d wait=%.3fs model=%s '
+                             'at %s: %s', elapsed, rows, wait, model, site,
+                             shape)
+
+    def stats(self):
+        """Return {shape: {count, rows, time, wait, p50, p95, p99, max,
+        slow}}, times in seconds.
+        """
+        result = {}
+        with self._lock:
+            for shape, stat in self._shapes.iteritems():
+                result[shape] = {
+                    'count': stat.time.count,
+                    'rows': stat.rows,
+                    'time': stat.time.total,
+                    'wait': stat.wait,
+                    'p50': stat.time.percentile(50),
+                    'p95': stat.time.percentile(95),
+                    'p99': stat.time.percentile(99),
+                    'max': stat.time.max,
+                    'slow': stat.slow,
+                }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._shapes = {}
+
+    def dump(self, fileobj):
+        """Write stats to fileobj as JSON, slowest shapes first.
+        """
+        stats = sorted(self.stats().items(), key=lambda item: -item[1]['time'])
+        json.dump([dict(shape=shape, **stat) for shape, stat in stats],
+                  fileobj, indent=1)
+
+
+statement_stats = StatementStats(getattr(config, 'mysqldb_slow', 1.0))
+
+
+def install_dump_signal(path, signum=signal.SIGUSR2):
+    """Dump statement_stats to path (formatted with the pid) when the
+    process receives signum, e.g. kill -USR2 <pid> on a live worker.
+    Must be called from the main thread.
+    """
+    def dump():
+        with open(path % {'pid': os.getpid()}, 'w') as fileobj:
+            statement_stats.dump(fileobj)
+
+    def handler(signum, frame):
+        # the signal may interrupt record() holding the stats lock, the
+        # dump waits for it in another thread
+        thread = threading.Thread(target=dump)
+        thread.daemon = True
+        thread.start()
+    signal.signal(signum, handler)
@@ -3,6 +3,11 @@ import re
 import decimal
 import datetime
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ..common import const
 
 
@@ -22,13 +27,85 @@ class FieldTypeError(FieldError):
     pass
 
 
+_epoch = datetime.datetime(1970, 1, 1)
+_datetime_re = re.compile(const.fieldfmt['datetime'])
+_date_re = re.compile(const.fieldfmt['date'])
+# character layouts of fieldfmt['datetime'] and fieldfmt['date'] for
+# column checks, 'd' is any digit
+_datetime_layout = 'dddd-dd-dd dd:dd:dd'
+_date_layout = 'dddd-dd-dd'
+
+
+def _column(col):
+    if numpy is None:
+        raise FieldError('numpy is not installed')
+    return numpy.asarray(col)
+
+
+def _map_invalid(func, col):
+    """Mask of the values of col for which func is false, calling it
+    on each value.
+    """
+    if not len(col):
+        return numpy.zeros(0, bool)
+    return ~numpy.frompyfunc(func, 1, 1)(col).astype(bool)
+
+
+def _layout_invalid(col, layout):
+    """Mask of the strings of col which do not follow layout, compared
+    character by character on a (rows, len(layout)) matrix of codes.
+    """
+    width = len(layout)
+    if col.dtype.kind == 'S':
+        codes = col.astype('S%d' % width).view('u1')
+    else:
+        codes = col.astype('U%d' % width).view('u4')
+    codes = codes.reshape(len(col), width)
+    bad = numpy.char.str_len(col) != width
+    for i, char in enumerate(layout):
+        if char == 'd':
+            bad |= (codes[:, i] < 48) | (codes[:, i] > 57)
+        else:
+            bad |= codes[:, i] != ord(char)
+    return bad
+
+
 class Field():
+    # array typecode and numpy dtype of a column of this field, see
+    # ModelData.columns; None keeps the values in a list
+    column_type = None
+    column_dtype = None
+
     def check(self, val):
         raise Exception('cannot be called')
 
+    def check_column(self, col):
+        """Check a column of values at once, e.g. a batch to insert.
+        Subclasses check numpy numbers, strings and datetime64 with
+        vectorized operations; other values go through check one by one.
+        @param col: numpy array, other sequences go through numpy.asarray
+        @return: numpy bool array, True for the invalid values
+        """
+        return self._check_each(_column(col))
+
+    def _check_each(self, col):
+        def valid(val):
+            try:
+                self.check(val)
+            except FieldError:
+                return False
+            return True
+        return _map_invalid(valid, col)
+
+    def to_column(self, val):
+        return val
+
     def to_str(self, val):
         return str(val)
 
+    def from_str(self, valstr):
+        return valstr
+
 
 class NumberField(Field):
     def __init__(self, minval=None, maxval=None):
@@ -42,6 +119,15 @@ class NumberField(Field):
             raise OutOfRange()
         return True
 
+    def _range_invalid(self, col):
+        bad = numpy.zeros(len(col), bool)
+        with numpy.errstate(invalid='ignore'):
+            if self._minval:
+                bad |= col < self._minval
+            if self._maxval:
+                bad |= col > self._maxval
+        return bad
+
 
 class IntField(NumberField):
     def check(self, val):
@@ -49,6 +135,25 @@ class IntField(NumberField):
             raise FieldTypeError(str(val) + ' is not number')
         return self.check_range(val)
 
+    column_type = 'l'
+    column_dtype = 'i8'
+
+    def check_column(self, col):
+        col = _column(col)
+        if col.dtype.kind in 'iu':
+            return self._range_invalid(col)
+        if col.dtype.kind == 'O':
+            return self._check_each(col)
+        return numpy.ones(len(col), bool)
+
+    def from_str(self, valstr):
+        return int(valstr)
+
+    def to_column(self, val):
+        if val is None:
+            raise FieldTypeError('NULL in integer column')
+        return int(val)
+
 
 class FloatField(NumberField):
     def check(self, val):
@@ -56,11 +161,31 @@ class FloatField(NumberField):
             raise FieldTypeError()
         return self.check_range(val)
 
+    column_type = 'd'
+    column_dtype = 'f8'
+
+    def check_column(self, col):
+        col = _column(col)
+        if col.dtype.kind == 'f':
+            return self._range_invalid(col)
+        if col.dtype.kind == 'O':
+            return self._check_each(col)
+        return numpy.ones(len(col), bool)
+
+    def from_str(self, valstr):
+        return float(valstr)
+
+    def to_column(self, val):
+        if val is None:
+            return float('nan')
+        return float(val)
+
 
 class MoneyField(Field):
     def __init__(self, minval, maxval, intn, deci):
         self._intn = intn
         self._deci = deci
+        self._re = re.compile(const.fieldfmt['money'] % (intn, deci))
         self._minval = decimal.Decimal(str(minval))
         self._maxval = decimal.Decimal(str(maxval))
 
@@ -68,24 +193,65 @@ class MoneyField(Field):
         if isinstance(val, decimal.Decimal):
             if (val < self._minval) or (val > self._maxval):
                 raise OutOfRange()
-            valstr = str(val)
-            pat = const.fieldfmt['money'] % (self._intn, self._deci)
-            if not re.match(pat, valstr):
+            if not self._re.match(str(val)):
                 raise FormatError()
             return True
         elif isinstance(val, (str, unicode)):
-            pat = const.fieldfmt['money'] % (self._intn, self._deci)
-            if not re.match(pat, val):
+            if not self._re.match(val):
                 raise FormatError()
         else:
             raise FieldTypeError()
 
+    column_type = 'l'
+    column_dtype = 'i8'
+
+    def check_column(self, col):
+        """Numbers are checked for digits and bounds, strings for format
+        and bounds, Decimal values with check.  NaN and infinities are
+        invalid.
+        """
+        col = _column(col)
+        if len(col) == 0:
+            return numpy.zeros(0, bool)
+        kind = col.dtype.kind
+        with numpy.errstate(invalid='ignore'):
+            if kind in 'SU':
+                parts = numpy.char.partition(col, '.')
+                intpart, dot, frac = parts[:, 0], parts[:, 1], parts[:, 2]
+                intlen = numpy.char.str_len(intpart)
+                fraclen = numpy.char.str_len(frac)
+                bad = ~numpy.char.isdigit(intpart) | (intlen > self._intn)
+                bad |= (dot != '') & (~numpy.char.isdigit(frac) |
+                                      (fraclen > self._deci))
+                col = numpy.where(bad, '0', col).astype(float)
+            elif kind in 'iuf':
+                bad = (col < 0) | (col >= 10 ** self._intn)
+                if kind == 'f':
+                    bad |= ~numpy.isfinite(col)
+                    scaled = col * 10 ** self._deci
+                    bad |= numpy.abs(scaled - numpy.rint(scaled)) > 1e-6
+            else:
+                return self._check_each(col)
+            bad |= (col < float(self._minval)) | (col > float(self._maxval))
+        return bad
+
+    def from_str(self, valstr):
+        return decimal.Decimal(valstr)
+
+    def to_column(self, val):
+        """Fixed-point integer, in units of 10**-deci
+        """
+        if val is None:
+            raise FieldTypeError('NULL in money column')
+        return int(decimal.Decimal(val).scaleb(self._deci))
+
 
 class CharField(Field):
     def __init__(self, minlen=None, maxlen=None, pat=None):
         self._minlen = minlen
         self._maxlen = maxlen
         self._pat = pat
+        self._re = re.compile(pat) if pat else None
 
     def check(self, val):
         if not isinstance(val, (str, unicode)):
@@ -94,10 +260,28 @@ class CharField(Field):
             raise OutOfRange()
         if self._maxlen and len(val) > self._maxlen:
             raise OutOfRange()
-        if self._pat and not re.match(self._pat, val):
+        if self._re and not self._re.match(val):
             raise FormatError(str(val) + '|' + self._pat)
         return True
 
+    def check_column(self, col):
+        """Lengths are checked at once, the pattern is still matched on
+        each value of the right length.
+        """
+        col = _column(col)
+        if col.dtype.kind not in 'SU':
+            return self._check_each(col)
+        lens = numpy.char.str_len(col)
+        bad = numpy.zeros(len(col), bool)
+        if self._minlen:
+            bad |= lens < self._minlen
+        if self._maxlen:
+            bad |= lens > self._maxlen
+        if self._re:
+            good = ~bad
+            bad[good] = _map_invalid(self._re.match, col[good])
+        return bad
+
     def to_str(self, val):
         if not isinstance(val, (str, unicode)):
             raise FieldTypeError()
@@ -105,15 +289,22 @@ class CharField(Field):
 
 
 class DateTimeField(Field):
+    # microseconds since 1970-01-01
+    column_type = 'l'
+    column_dtype = 'M8[us]'
+
     def check(self, val):
         if isinstance(val, datetime.datetime):
             return True
         elif isinstance(val, (str, unicode)):
-            if not re.match(const.fieldfmt['datetime'], val):
+            if not _datetime_re.match(val):
                 raise FormatError()
         else:
             raise FieldTypeError()
 
+    def check_column(self, col):
+        return _check_dates(self, _column(col), _datetime_layout)
+
     def to_str(self, val):
         if isinstance(val, (str, unicode)):
             return val
@@ -122,13 +313,51 @@ class DateTimeField(Field):
         else:
             raise FieldTypeError()
 
+    def from_str(self, valstr):
+        if '.' in valstr:
+            return datetime.datetime.strptime(valstr, '%Y-%m-%d %H:%M:%S.%f')
+        return datetime.datetime.strptime(valstr, '%Y-%m-%d %H:%M:%S')
+
+    def to_column(self, val):
+        if val is None:
+            raise FieldTypeError('NULL in datetime column')
+        delta = val - _epoch
+        return (delta.days * 86400 + delta.seconds) * 1000000 + \
+            delta.microseconds
+
 
 class DateField(Field):
+    # days since 1970-01-01
+    column_type = 'l'
+    column_dtype = 'M8[D]'
+
     def check(self, val):
         if isinstance(val, datetime.date):
             return True
         elif isinstance(val, (str, unicode)):
-            if not re.match(const.fieldfmt['date'], val):
+            if not _date_re.match(val):
                 raise FormatError()
         else:
             raise FieldTypeError()
+
+    def check_column(self, col):
+        return _check_dates(self, _column(col), _date_layout)
+
+    def from_str(self, valstr):
+        return datetime.datetime.strptime(valstr, '%Y-%m-%d').date()
+
+    def to_column(self, val):
+        if val is None:
+            raise FieldTypeError('NULL in date column')
+        return (val - _epoch.date()).days
+
+
+def _check_dates(fd, col, layout):
+    """Column check of DateTimeField and DateField: datetime64 values are
+    valid unless NaT, strings must follow layout.
+    """
+    if col.dtype.kind == 'M':
+        return numpy.isnat(col)
+    if col.dtype.kind in 'SU':
+        return _layout_invalid(col, layout)
+    return fd._check_each(col)
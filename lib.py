@@ -137,7 +137,14 @@ class BaseHandler(webapp2.RequestHandler):
         method = self.request.get('_method')
         if method:
             self.request.route.handler_method = method.lower()
-        rv = super(BaseHandler, self).dispatch()
+        try:
+            rv = super(BaseHandler, self).dispatch()
+        finally:
+            # reads of the next request may go to replicas again; db is
+            # only imported by apps using MySQL
+            db = sys.modules.get(__name__.rpartition('.')[0] + '.db')
+            if db is not None:
+                db.end_request()
         self.response.write(rv)
 
     def get_client_ip(self):
@@ -0,0 +1,144 @@
+# coding: utf8
+import time
+import threading
+
+from ..common import db
+from ..common import cache
+from ..common import record
+
+
+# types whose values compare equal in Python and MySQL alike
+_kinds = {int: long, bool: long, unicode: str}
+
+
+def _kind(value):
+    return _kinds.get(type(value), type(value))
+
+
+class Mirror(object):
+    """Whole table kept in process with hash indexes on some fields.  Set
+    it as Model.mirror of a small read-mostly table: reads whose filters
+    are all equalities or IN lists are then answered here, with order,
+    limit and count, without querying MySQL.
+    The table is loaded on first use, and again ttl seconds later or as
+    soon as its cache.query_cache version changed, i.e. after a write
+    through the model in this process.  Writes of other processes are
+    seen after ttl at most.  Partitioned models are loaded from all their
+    partitions.
+    Values are compared with Python equality, not the column collation
+    and conversions of MySQL, so reads are sent to MySQL when a filter
+    value is NULL, has another type than the values of its column, e.g.
+    '5' for an INT, or is a string on a field not in binary.
+    @param indexes: fields with a hash index, filters on other fields
+                    scan the rows
+    @param binary: string fields whose collation is case and accent
+                   sensitive, e.g. utf8_bin, filtered here
+    @param ttl: seconds between reloads
+    """
+    def __init__(self, indexes=(), ttl=300, binary=()):
+        self.indexes = tuple(indexes)
+        self.binary = frozenset(binary)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (version, expire time, rows, {field: {value: [row positions]}},
+        #  {field: set of value kinds})
+        self._state = None
+        self._loads = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _stale(self, state, model):
+        return (state is None or state[1] < time.time() or
+                state[0] != cache.query_cache.versions((model.table,)))
+
+    def _load(self, model):
+        # the version is taken first, a write during the load causes
+        # another one
+        version = cache.query_cache.versions((model.table,))
+        tables = [model.table]
+        if model.partition is not None:
+            # the model table is only the empty template of the partitions
+            tables = model.partition.tables(model.table) or tables
+        names, rows = db.select_tuples(' UNION ALL '.join(
+            ['SELECT * FROM `%s`' % table for table in tables]), [])
+        cls = record.record_class(model.__name__, names)
+        rows = [cls(row) for row in rows]
+        indexes = {}
+        for name in self.indexes:
+            index = indexes[name] = {}
+            for i, row in enumerate(rows):
+                index.setdefault(row[name], []).append(i)
+        kinds = {}
+        for i, name in enumerate(names):
+            kinds[name] = set([_kind(row[i]) for row in rows
+                               if row[i] is not None])
+        return version, time.time() + self.ttl, rows, indexes, kinds
+
+    def _comparable(self, name, values, kinds):
+        """Whether values of a filter on name match here as in MySQL.
+        """
+        for value in values:
+            kind = _kind(value)
+            if value is None or kind is str and name not in self.binary:
+                return False
+            if kinds.get(name) and kinds[name] != set([kind]):
+                return False
+        return True
+
+    def _current(self, model):
+        state = self._state
+        if self._stale(state, model):
+            with self._lock:
+                state = self._state
+                if self._stale(state, model):
+                    state = self._state = self._load(model)
+                    self._loads = self._loads + 1
+        return state
+
+    def select(self, model, filts, args):
+        """Return the records of model matching filts, in table order,
+        or None when they must be read from MySQL.
+        @param filts: filter shapes (name, op, nvalue) of ModelData, op
+                      is '' or 'in'
+        @param args: their arguments
+        """
+        version, expire, rows, indexes, kinds = self._current(model)
+        conds = []
+        offset = 0
+        for name, op, nvalue in filts:
+            values = set(args[offset:offset + nvalue])
+            offset = offset + nvalue
+            if not self._comparable(name, values, kinds):
+                self._misses = self._misses + 1
+                return None
+            conds.append((name, values))
+        found = None
+        for name, values in conds:
+            if name in indexes:
+                index = indexes[name]
+                positions = []
+                for value in values:
+                    positions.extend(index.get(value, ()))
+                if found is None or len(positions) < len(found):
+                    found = positions
+        if found is None:
+            found = rows
+        else:
+            found = [rows[i] for i in sorted(found)]
+        self._hits = self._hits + 1
+        return [row for row in found
+                if all([row[name] in values for name, values in conds])]
+
+    def invalidate(self):
+        """Drop the rows, the next read loads them again.
+        """
+        self._state = None
+
+    def stats(self):
+        state = self._state
+        return {
+            'rows': len(state[2]) if state else 0,
+            'loads': self._loads,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
@@ -1,5 +1,27 @@
 # coding: utf-8
+import copy
+import json
+import time
+import array
+import decimal
+import datetime
+import base64
+import itertools
+import logging
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .. import config
 from ..common import db
+from ..common import field as _field
+from ..common import cache
+from ..common import record
+from ..common import partition as _partition
+from ..common import writebehind
 
 
 class ModelError(Exception):
@@ -49,33 +71,409 @@ class DeleteError(ModelError):
     pass
 
 
+class FullScanError(ModelError):
+    pass
+
+
+_log = logging.getLogger(__name__)
+
+
+class SqlCache(object):
+    """Bounded LRU of SQL templates keyed by query shape.  A shape holds
+    everything that goes into the SQL text (table, filter columns and
+    operators, order, group, join, lock...), never the argument values,
+    so repeated queries only have to bind their arguments.
+    Hits only stamp the entry with a tick and take no lock; when the
+    cache overflows the least recently stamped quarter is evicted.
+    """
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._sqls = {}
+        self._lock = threading.Lock()
+        self._tick = itertools.count()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, build, *args):
+        """Return the SQL of key, calling build(*args) on a miss.
+        """
+        entry = self._sqls.get(key)
+        if entry is not None:
+            entry[1] = next(self._tick)
+            self._hits = self._hits + 1
+            return entry[0]
+        self._misses = self._misses + 1
+        sql = build(*args)
+        if self._maxsize > 0:
+            with self._lock:
+                self._sqls[key] = [sql, next(self._tick)]
+                if len(self._sqls) > self._maxsize:
+                    self._evict(self._maxsize - self._maxsize // 4)
+        return sql
+
+    def _evict(self, keep):
+        items = sorted(self._sqls.iteritems(), key=lambda item: item[1][1])
+        for key, entry in items[:len(items) - max(keep, 0)]:
+            del self._sqls[key]
+
+    def resize(self, maxsize):
+        """Change the bound, 0 disables caching.
+        """
+        with self._lock:
+            self._maxsize = maxsize
+            if len(self._sqls) > maxsize:
+                self._evict(maxsize)
+
+    def clear(self):
+        with self._lock:
+            self._sqls.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._sqls),
+            'maxsize': self._maxsize,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+
+sql_cache = SqlCache()
+
+
+_filter_fmts = {
+    '': '`%s`=%%s',
+    'neq': '`%s`!=%%s',
+    'le': '`%s`<=%%s',
+    'lt': '`%s`<%%s',
+    'gt': '`%s`>%%s',
+    'ge': '`%s`>=%%s',
+    'like': '`%s` like %%s',
+}
+
+
+def _compile_filter(filt, prefix=''):
+    """filt is (name, op, nvalue), see ModelData._gen_filter
+    """
+    name, op, nvalue = filt
+    if op == 'in':
+        if not nvalue:
+            return '1=0'
+        return prefix + '`%s` IN (%s)' % (name, ','.join(['%s'] * nvalue))
+    return prefix + _filter_fmts[op] % name
+
+
+def _in_size(nvalue):
+    """Round lengths of IN lists up to a power of two, so that lists of
+    close lengths share one compiled SQL.  The list is padded with its
+    last value, which does not change the result.
+    """
+    if nvalue <= 8:
+        return nvalue
+    size = 16
+    while size < nvalue:
+        size = size * 2
+    return size
+
+
+def _compile_where(filts, prefix=''):
+    return ' AND '.join([_compile_filter(filt, prefix) for filt in filts])
+
+
+def _compile_seek(keys, desc, prefix=''):
+    """Rows after the one whose keys are bound, in the order of keys:
+    (a>%s OR (a=%s AND b>%s))
+    """
+    op = '<' if desc else '>'
+    conds = []
+    for i, key in enumerate(keys):
+        eqs = ['%s`%s`=%%s' % (prefix, k) for k in keys[:i]]
+        cond = ' AND '.join(eqs + ['%s`%s`%s%%s' % (prefix, key, op)])
+        conds.append('(%s)' % cond if eqs else cond)
+    return '(%s)' % ' OR '.join(conds)
+
+
+def _seek_args(values):
+    args = []
+    for i in range(len(values)):
+        args.extend(values[:i + 1])
+    return args
+
+
+_bucket_fmts = {
+    'min': 'MIN(`%(col)s`)',
+    'max': 'MAX(`%(col)s`)',
+    'avg': 'AVG(`%(col)s`)',
+    'sum': 'SUM(`%(col)s`)',
+    'count': 'COUNT(`%(col)s`)',
+    'first': "SUBSTRING_INDEX(GROUP_CONCAT(`%(col)s` ORDER BY `%(field)s` "
+             "SEPARATOR ','), ',', 1)",
+    'last': "SUBSTRING_INDEX(GROUP_CONCAT(`%(col)s` ORDER BY `%(field)s` DESC "
+            "SEPARATOR ','), ',', 1)",
+}
+
+
+# fields whose values never contain the GROUP_CONCAT separator
+_concat_safe = (_field.NumberField, _field.MoneyField, _field.DateTimeField,
+                _field.DateField)
+
+
+def _compile_bucket(bucket):
+    field, interval, aggs = bucket
+    cols = ['FLOOR(UNIX_TIMESTAMP(`%s`)/%d) AS `_bucket`' % (field, interval)]
+    for name, func, col in aggs:
+        cols.append('%s AS `%s`' % (
+            _bucket_fmts[func] % {'col': col, 'field': field}, name))
+    return ','.join(cols)
+
+
+def _compile_select(shape):
+    (table, filts, join, order, group, limit, lock, count, fields, funcs,
+     timesample, seek, bucket) = shape
+    sqls = []
+    sqls.append('SELECT')
+    if count:
+        sqls.append('COUNT(*)')
+    elif bucket:
+        sqls.append(_compile_bucket(bucket))
+    elif join:
+        sqls.append(table + '.*')
+    elif fields or funcs:
+        _fields = [fd.join(('`','`')) for fd in fields] + \
+                  [' AS '.join((val, key)) for key, val in funcs]
+        sqls.append(','.join(_fields))
+    else:
+        sqls.append('*')
+    sqls.append('FROM')
+    sqls.append('`'+table+'`')
+    if join:
+        lfield, rtable, rfield, rfilts = join
+        filtstrs = [_compile_where(filts, table + '.'),
+                    _compile_where(rfilts, rtable + '.')]
+        sqls.append('LEFT JOIN')
+        sqls.append(rtable)
+        sqls.append('ON')
+        sqls.append('%s.%s=%s.%s' % (table, lfield, rtable, rfield))
+    else:
+        filtstrs = [_compile_where(filts)]
+    if timesample:
+        field, interval = timesample
+        filtstrs.append('TIMESTAMPDIFF(SECOND, @cur_time, `%s`)>=%d' %
+                        (field, interval))
+        filtstrs.append('@cur_time:=`%s`' % field)
+    if seek:
+        keys, desc, after = seek
+        if after:
+            filtstrs.append(_compile_seek(keys, desc,
+                                          table + '.' if join else ''))
+        order = None
+    filtstr = ' AND '.join([filt for filt in filtstrs if filt])
+    if filtstr:
+        sqls.append('WHERE')
+        sqls.append(filtstr)
+    if group:
+        sqls.append('GROUP BY `%s`' % group)
+    elif bucket and not count:
+        sqls.append('GROUP BY `_bucket` ORDER BY `_bucket`')
+        order = seek = None
+    if order:
+        name, desc = order
+        sqls.append('ORDER BY `%s` %s' % (name, desc))
+    elif seek:
+        sqls.append('ORDER BY ' + ','.join(['`%s` %s' % (key, desc)
+                                            for key in keys]))
+    if limit:
+        sqls.append('LIMIT %s,%s')
+    if lock:
+        sqls.append(lock)
+    return ' '.join(sqls)
+
+
+def _compile_delete(shape):
+    table, filts = shape
+    sqls = []
+    sqls.append('DELETE')
+    sqls.append('FROM')
+    sqls.append('`'+table+'`')
+    filtstr = _compile_where(filts)
+    if filtstr:
+        sqls.append('WHERE')
+        sqls.append(filtstr)
+    return ' '.join(sqls)
+
+
+def _compile_partitions(sql, table, tables, filts):
+    if len(tables) == 1:
+        source = '`%s` AS `%s`' % (tables[0], table)
+    else:
+        where = _compile_where(filts)
+        if where:
+            where = ' WHERE ' + where
+        source = '(%s) AS `%s`' % (' UNION ALL '.join(
+            ['SELECT * FROM `%s`%s' % (part, where) for part in tables]),
+            table)
+    return sql.replace('FROM `%s`' % table, 'FROM ' + source, 1)
+
+
+def _split(value, sep):
+    if not value:
+        return []
+    return [item.strip() for item in value.split(sep)]
+
+
+def _explain(sql, args, envs):
+    plan = []
+    for row in db.select('EXPLAIN ' + sql, args, envs):
+        plan.append({
+            'id': row.get('id'),
+            'select_type': row.get('select_type'),
+            'table': row.get('table'),
+            'type': row.get('type'),
+            'possible_keys': _split(row.get('possible_keys'), ','),
+            'key': row.get('key'),
+            'key_len': row.get('key_len'),
+            'ref': row.get('ref'),
+            'rows': row.get('rows'),
+            'filtered': row.get('filtered'),
+            'extra': _split(row.get('Extra'), ';'),
+        })
+    return plan
+
+
+class ScanCheck(object):
+    """Development and test check which EXPLAINs every new query shape
+    once and flags full table scans (type ALL) and filesorts on tables
+    of min_rows rows or more.  Enable it with config.scan_check, e.g.
+    {'min_rows': 1000, 'strict': True}.
+    @param strict: raise FullScanError instead of logging a warning
+    """
+    def __init__(self, min_rows=1000, strict=False):
+        self.min_rows = min_rows
+        self.strict = strict
+        self.flagged = []
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def check(self, sql, args, envs):
+        with self._lock:
+            if sql in self._seen:
+                return
+            self._seen.add(sql)
+        problems = []
+        for row in _explain(sql, args, envs):
+            if (row['rows'] or 0) < self.min_rows:
+                continue
+            if row['type'] == 'ALL':
+                problems.append('full scan of %s' % row['table'])
+            if 'Using filesort' in row['extra']:
+                problems.append('filesort on %s' % row['table'])
+        if problems:
+            msg = '%s: %s' % (', '.join(problems), sql)
+            self.flagged.append(msg)
+            if self.strict:
+                raise FullScanError(msg)
+            _log.warning(msg)
+
+
+scan_check = None
+if getattr(config, 'scan_check', None) is not None:
+    scan_check = ScanCheck(**config.scan_check)
+
+
+_table_rows_sql = 'SELECT SUM(TABLE_ROWS) AS TABLE_ROWS ' \
+                  'FROM information_schema.TABLES ' \
+                  'WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME IN (%s)'
+_count_cache = cache.LruCache(1024)
+
+
+def _invalidate(table):
+    """Invalidate the cached reads of table once the write is committed:
+    reads cached before the commit of a transaction saw the old rows.
+    """
+    db.after_transaction(cache.query_cache.invalidate, table)
+
+
+class _Bucket(object):
+    """Aggregates of one downsampling bucket, fed row by row.
+    """
+    def __init__(self, field, start, interval, aggs):
+        self.start = start
+        self._field = field
+        self._interval = interval
+        self._aggs = aggs
+        self._values = [None] * len(aggs)
+        self._counts = [0] * len(aggs)
+
+    def add(self, row):
+        for i, (name, func, col) in enumerate(self._aggs):
+            val = row[col]
+            if val is None:
+                continue
+            cur = self._values[i]
+            self._counts[i] = self._counts[i] + 1
+            if func == 'first':
+                if self._counts[i] == 1:
+                    self._values[i] = val
+            elif func == 'last':
+                self._values[i] = val
+            elif func == 'min':
+                if cur is None or val < cur:
+                    self._values[i] = val
+            elif func == 'max':
+                if cur is None or val > cur:
+                    self._values[i] = val
+            elif func in ('sum', 'avg'):
+                self._values[i] = val if cur is None else cur + val
+
+    def output(self):
+        start = self.start * self._interval
+        row = {self._field: datetime.datetime.fromtimestamp(start)}
+        for i, (name, func, col) in enumerate(self._aggs):
+            val = self._values[i]
+            if func == 'count':
+                val = self._counts[i]
+            elif func == 'avg' and val is not None:
+                if not isinstance(val, decimal.Decimal):
+                    val = float(val)
+                val = val / self._counts[i]
+            row[name] = val
+        return row
+
+
 class ModelData():
     def __init__(self, model):
         self._model = model
-        self._orderstr = ''
-        self._groupstr = ''
+        self._order = None
+        self._group = None
         self._filts = []
         self._filtargs = []
         self._data = None
         self._joins = []
         self._jointype = ''
-        self._limitstr = ''
+        self._limit = None
+        self._seek = None
+        self._seekargs = []
+        self._bucket = None
         self._time_interval = None
         self._time_begin = None
         self._time_end = None
+        self._cached = model.cached
+        self._records = model.records
+        self._prefetches = []
+        # partitions read, None to select them from the filters
+        self._parts = None
 
     def _gen_filter_in(self, name, values):
         """
-        (name=v1 OR name=v2)
+        name IN (v1,v2)
         """
         if not isinstance(values, (tuple, list, dict)):
             raise FilterInputError()
-        filtone = '`%s`=%%s' % name
-        filtstr = ' OR '.join([filtone] * len(values))
-        filtstr = '(%s)' % filtstr
-        if not isinstance(values, (tuple, list, dict)):
-            raise FilterInputError()
-        return filtstr, list(values)
+        values = list(values)
+        size = _in_size(len(values))
+        values.extend(values[-1:] * (size - len(values)))
+        return (name, 'in', size), values
 
     def _gen_filter(self, col, val):
         """
@@ -84,51 +482,44 @@ class ModelData():
         name__le=value: name<=value
         name__gt=value: name>value
         name__ge=value: name>=value
-        name__in=(v1,v2): (name=v1 OR name=v2)
+        name__in=(v1,v2): name IN (v1,v2)
         name__like=value: name like value
+        Return the filter shape (name, op, nvalue) and its arguments.
         """
         argv = col.split('__')
         argc = len(argv)
         if argc == 1:
-            if argv[0] not in self._model.fields:
-                raise NoFieldError(argv[0])
-            filtstr = '`%s`=%%s' % col
+            op = ''
         elif argc == 2:
-            if argv[0] not in self._model.fields:
-                raise NoFieldError(argv[0])
-            if argv[1] == 'neq':
-                filtstr = '`%s`!=%%s' % argv[0]
-            if argv[1] == 'le':
-                filtstr = '`%s`<=%%s' % argv[0]
-            if argv[1] == 'lt':
-                filtstr = '`%s`<%%s' % argv[0]
-            if argv[1] == 'gt':
-                filtstr = '`%s`>%%s' % argv[0]
-            if argv[1] == 'ge':
-                filtstr = '`%s`>=%%s' % argv[0]
-            if argv[1] == 'like':
-                filtstr = '`%s` like %%s' % argv[0]
-            if argv[1] == 'in':
+            op = argv[1]
+            if op == 'in':
+                if argv[0] not in self._model.fields:
+                    raise NoFieldError(argv[0])
                 return self._gen_filter_in(argv[0], val)
+            if op not in _filter_fmts:
+                raise FilterInputError(col)
         else:
             raise FilterInputError()
+        if argv[0] not in self._model.fields:
+            raise NoFieldError(argv[0])
         if isinstance(val, (tuple, list, dict)):
             raise FilterInputError()
-        return filtstr, [val]
+        return (argv[0], op, 1), [val]
 
     def filter(self, **kv):
         if not kv:
             return self
         for col, val in kv.iteritems():
-            filtstr, filtargs = self._gen_filter(col, val)
-            self._filts.append(filtstr)
-            self._filtargs = self._filtargs + filtargs
+            filt, filtargs = self._gen_filter(col, val)
+            self._filts.append(filt)
+            self._filtargs.extend(filtargs)
         self._data = None
         return self
 
     def orderby(self, *args):
         if not args:
-            self._orderstr = ''
+            self._order = None
+            return self
         if len(args) > 1:
             raise DupOrderError()
         name = args[0]
@@ -138,27 +529,73 @@ class ModelData():
             name = name[1:len(name)]
         if name not in self._model.fields:
             raise NoFieldError(name)
-        self._orderstr = 'ORDER BY `%s` %s' % (name, desc)
+        self._order = (name, desc)
         self._data = None
         return self
 
     def groupby(self, *args):
         if not args:
-            self._groupstr = ''
+            self._group = None
+            return self
         if len(args) > 1:
             raise DupGroupError()
         name = args[0]
         if name not in self._model.fields:
             raise NoFieldError(name)
-        self._groupstr = 'GROUP BY `%s`' % name
+        self._group = name
         self._data = None
         return self
 
     def limit(self, ndata, offset):
-        self._limitstr = 'LIMIT %d,%d' % (offset, ndata)
+        self._limit = (int(offset), int(ndata))
         self._data = None
         return self
 
+    def _clone(self):
+        other = copy.copy(self)
+        other._filts = list(self._filts)
+        other._filtargs = list(self._filtargs)
+        other._data = None
+        return other
+
+    def prefetch(self, field, rmodel, rfield, name=None, many=False):
+        """After each read, load the rows of rmodel whose rfield equals
+        field of the rows read, in one query for all of them, and attach
+        them to each row under name (rmodel table by default).
+        @param rmodel: Model class, or ModelData with extra filters
+        @param many: attach the list of related rows instead of the
+                     first one (None when there is none)
+        """
+        if not isinstance(rmodel, ModelData):
+            rmodel = rmodel.data()
+        if field not in self._model.fields:
+            raise NoFieldError(field)
+        if rfield not in rmodel._model.fields:
+            raise NoFieldError(rfield)
+        if name is None:
+            name = rmodel._model.table
+        self._prefetches.append((field, rmodel, rfield, name, many))
+        self._data = None
+        return self
+
+    def _load_prefetches(self, data):
+        for field, rmodel, rfield, name, many in self._prefetches:
+            keys = set([row[field] for row in data])
+            keys.discard(None)
+            related = {}
+            if keys:
+                rdata = rmodel._clone().filter(**{rfield + '__in': list(keys)})
+                for rrow in rdata.getall():
+                    related.setdefault(rrow[rfield], []).append(rrow)
+            for i, row in enumerate(data):
+                rrows = related.get(row[field], [])
+                if not many:
+                    rrows = rrows[0] if rrows else None
+                if isinstance(row, record.Record):
+                    data[i] = row._extend(name, rrows)
+                else:
+                    row[name] = rrows
+
     def leftjoin(self, lfield, rmodel, rfield):
         if self._joins:
             raise DupJoinError()
@@ -166,16 +603,43 @@ class ModelData():
         self._jointype = 'LEFT JOIN'
         return self
 
+    def cached(self, on=True):
+        """Read through cache.query_cache, overriding Model.cached.
+        Reads with FOR UPDATE or in a transaction always skip the cache.
+        """
+        self._cached = on
+        self._data = None
+        return self
+
+    def records(self, on=True):
+        """Return rows as record.Record, overriding Model.records.
+        """
+        self._records = on
+        self._data = None
+        return self
+
+    def _select_records(self, sql, args, envs):
+        names, rows = db.select_tuples(sql, args, envs)
+        cls = record.record_class(self._model.__name__, names)
+        return [cls(row) for row in rows]
+
     def update(self, **kv):
         self._model.check(**kv)
-        filtstr = ' AND '.join(self._filts)
+        filts = tuple(self._filts)
+        filtstr = sql_cache.get(('WHERE', filts), _compile_where, filts)
         try:
-            db.update(self._model.table, filtstr, *self._filtargs, **kv)
+            for table in self._write_tables():
+                db.update(table, filtstr, *self._filtargs, **kv)
         except db.DbError:
             raise UpdateError
+        finally:
+            _invalidate(self._model.table)
         self._data = None
 
     def timesample(self, field, interval, begin=None, end=None):
+        """Keep rows at least interval seconds apart, see downsample for
+        a bucketed alternative.
+        """
         self._time_field = field
         self._time_interval = interval
         self._time_begin = begin
@@ -188,89 +652,425 @@ class ModelData():
         self._time_end = end
         return self
 
-    def _read(self, lock=None, count=False, fields=None, funcs=None):
-        outcols = '*'
+    def _bucket_aggs(self, field, interval, begin, end, aggs):
+        if field not in self._model.fields:
+            raise NoFieldError(field)
+        if int(interval) <= 0:
+            raise FilterInputError('interval must be positive')
+        _aggs = []
+        for name, (func, col) in sorted(aggs.items()):
+            if func not in _bucket_fmts:
+                raise FilterInputError(func)
+            if col not in self._model.fields:
+                raise NoFieldError(col)
+            _aggs.append((name, func, col))
+        filts = {}
+        if begin:
+            filts[field + '__ge'] = begin
+        if end:
+            filts[field + '__le'] = end
+        self.filter(**filts)
+        return tuple(_aggs)
+
+    def downsample(self, field, interval, begin=None, end=None, **aggs):
+        """Group rows into buckets of interval seconds on the time field
+        and aggregate each bucket in MySQL.  Unlike timesample it needs
+        no user variables and the result is one row per bucket.
+        @param aggs: name=(func, column), func is one of min, max, avg,
+                     sum, count, first, last; first and last take number
+                     and date columns only, they are cut from a
+                     comma-separated GROUP_CONCAT
+        @return rows ordered by time, field is the bucket start; rows
+                whose field is NULL are left out
+        """
+        aggs = self._bucket_aggs(field, interval, begin, end, aggs)
+        for name, func, col in aggs:
+            if func in ('first', 'last') and not isinstance(
+                    self._model.fields[col], _concat_safe):
+                raise FilterInputError('%s of %s' % (func, col))
+        self._bucket = (field, int(interval), aggs)
+        try:
+            self._read()
+        finally:
+            self._bucket = None
+        data, self._data = self._data, None
+        rows = []
+        for row in data:
+            row = dict(row)
+            bucket = row.pop('_bucket')
+            if bucket is None:
+                continue
+            start = int(bucket) * int(interval)
+            row[field] = datetime.datetime.fromtimestamp(start)
+            for name, func, col in aggs:
+                if func in ('first', 'last') and row[name] is not None:
+                    row[name] = self._model.fields[col].from_str(row[name])
+            rows.append(row)
+        return rows
+
+    def iter_downsample(self, field, interval, begin=None, end=None,
+                        batch_size=1000, **aggs):
+        """Same as downsample, but rows are streamed by iter() and
+        aggregated here as they arrive, yielding one row per bucket.
+        """
+        interval = int(interval)
+        aggs = self._bucket_aggs(field, interval, begin, end, aggs)
+        data = self._clone()
+        data.orderby(field)
+        bucket = None
+        for row in data.iter(batch_size):
+            if row[field] is None:
+                continue
+            start = int(time.mktime(row[field].timetuple())) // interval
+            if bucket is None or bucket.start != start:
+                if bucket is not None:
+                    yield bucket.output()
+                bucket = _Bucket(field, start, interval, aggs)
+            bucket.add(row)
+        if bucket is not None:
+            yield bucket.output()
+
+    def _shape(self, lock=None, count=False, fields=None, funcs=None):
+        join = None
+        if self._joins:
+            lfield, rmodel, rfield = self._joins[0]
+            join = (lfield, rmodel._model.table, rfield, tuple(rmodel._filts))
+        timesample = None
+        if self._time_interval:
+            timesample = (self._time_field, self._time_interval)
+        return (self._model.table, tuple(self._filts), join, self._order,
+                self._group, self._limit is not None, lock, count,
+                tuple(fields or ()), tuple(sorted((funcs or {}).items())),
+                timesample, self._seek, self._bucket)
+
+    def _gen_sql(self, lock=None, count=False, fields=None, funcs=None):
         envs = {}
-        sqls = []
         if self._time_interval and self._time_begin:
             envs['cur_time'] = str(self._time_begin)
-        sqls.append('SELECT')
-        if count:
-            sqls.append('COUNT(*)')
-        elif self._joins:
-            sqls.append(self._model.table + '.*')
-        elif fields or funcs:
-            _fields = [fd.join(('`','`')) for fd in fields] + \
-                      [' AS '.join((val, key)) for key, val in funcs.items()]
-            sqls.append(','.join(_fields))
-        else:
-            sqls.append('*')
-        sqls.append('FROM')
-        sqls.append('`'+self._model.table+'`')
+        shape = self._shape(lock, count, fields, funcs)
+        sql = sql_cache.get(('SELECT', shape), _compile_select, shape)
+        args = self._filtargs
         if self._joins:
-            prefix = self._model.table + '.'
-            filts = [prefix + filt for filt in self._filts]
-            args = self._filtargs
-            join = self._joins[0]
-            lfield, rmodel, rfield = join
-            prefix = rmodel._model.table + '.'
-            filts = filts + [prefix + filt for filt in rmodel._filts]
-            args = args + rmodel._filtargs
-            joins = '%s.%s=%s.%s' % (self._model.table,
-                                     lfield,
-                                     rmodel._model.table,
-                                     rfield)
-            sqls.append('LEFT JOIN')
-            sqls.append(rmodel._model.table)
-            sqls.append('ON')
-            sqls.append(joins)
+            args = args + self._joins[0][1]._filtargs
+        if self._seekargs:
+            args = args + self._seekargs
+        if self._limit:
+            args = args + list(self._limit)
+        if self._model.partition is not None:
+            sql, args = self._from_partitions(sql, args, self._partitions())
+        return sql, args, envs
+
+    def _partitions(self):
+        """Partitions the read touches, None when Model.partition is not
+        set.
+        """
+        if self._model.partition is None:
+            return None
+        if self._parts is not None:
+            return self._parts
+        try:
+            return self._model.partition.select(self._model.table,
+                                                self._filts, self._filtargs)
+        except _partition.PartitionError, e:
+            raise FilterInputError(str(e))
+        except db.DbError:
+            raise ReadError()
+
+    def _write_tables(self):
+        tables = self._partitions()
+        if tables is None:
+            return [self._model.table]
+        return tables
+
+    def _from_partitions(self, sql, args, tables):
+        """Read tables instead of the model table, one under the model
+        table name, several in a UNION ALL of the filtered partitions.
+        Without partitions the empty model table is read.
+        """
+        if not tables:
+            return sql, args
+        table = self._model.table
+        key = ('PARTITIONS', sql, tuple(tables), tuple(self._filts))
+        sql = sql_cache.get(key, _compile_partitions, sql, table, tables,
+                            tuple(self._filts))
+        if len(tables) > 1:
+            args = self._filtargs * len(tables) + args
+        return sql, args
+
+    def _tables(self):
+        tables = [self._model.table]
+        if self._model.partition is not None:
+            tables.extend(self._partitions())
+        if self._joins:
+            tables.append(self._joins[0][1]._model.table)
+        return tables
+
+    def _split_in(self):
+        """Return the index and offset in _filtargs of the IN filter
+        with the most distinct values if they are more than
+        Model.in_chunk, else None.  The padding of _in_size is not
+        counted.
+        """
+        split = None
+        nvalue = self._model.in_chunk
+        offset = 0
+        for i, (name, op, n) in enumerate(self._filts):
+            if op == 'in' and n > nvalue:
+                distinct = len(set(self._filtargs[offset:offset + n]))
+                if distinct > nvalue:
+                    split = (i, offset)
+                    nvalue = distinct
+            offset = offset + n
+        return split
+
+    def _select_chunks(self, split, count, fields):
+        """Split the IN filter at split into chunks of Model.in_chunk
+        values, run them concurrently and merge the rows.
+        """
+        index, offset = split
+        name, op, nvalue = self._filts[index]
+        values = []
+        seen = set()
+        for val in self._filtargs[offset:offset + nvalue]:
+            if val not in seen:
+                seen.add(val)
+                values.append(val)
+        chunk = self._model.in_chunk
+        parts = []
+        for begin in range(0, len(values), chunk):
+            filt, filtargs = self._gen_filter_in(name,
+                                                 values[begin:begin + chunk])
+            part = copy.copy(self)
+            part._filts = self._filts[:index] + [filt] + \
+                          self._filts[index + 1:]
+            part._filtargs = self._filtargs[:offset] + filtargs + \
+                             self._filtargs[offset + nvalue:]
+            parts.append(part)
+        return self._select_parts(parts, count, fields)
+
+    def _select_partitions(self, tables, count, fields, lock=None):
+        """Read each partition in its own query, run concurrently, and
+        merge the rows.
+        """
+        parts = []
+        for table in tables:
+            part = copy.copy(self)
+            part._parts = [table]
+            parts.append(part)
+        return self._select_parts(parts, count, fields, lock)
+
+    def _select_parts(self, parts, count, fields, lock=None):
+        """Run the reads of parts concurrently and merge their rows in
+        the order and limit of this read.  The merge sorts in Python
+        order, not in the collation of the column, e.g. 'B' before 'a'.
+        A single part is read as is.
+        """
+        if len(parts) == 1:
+            load = self._select_records if self._records else db.select
+            return load(*parts[0]._gen_sql(lock, count, fields))
+        queries = []
+        for part in parts:
+            if self._limit:
+                part._limit = (0, self._limit[0] + self._limit[1])
+            queries.append(part._gen_sql(lock, count, fields))
+        if self._records:
+            results = db.select_parallel(queries, func=self._select_records)
         else:
-            filts = self._filts
-            args = self._filtargs
-        filtstr = ' AND '.join(filts)
-        if filtstr:
-            sqls.append('WHERE')
-            sqls.append(filtstr)
-        if self._time_interval:
-            sqls.append('AND')
-            sqls.append('TIMESTAMPDIFF(SECOND, @cur_time, `%s`)>=%d' % (self._time_field, self._time_interval))
-            sqls.append('AND')
-            sqls.append('@cur_time:=`%s`' % self._time_field)
-        if self._orderstr:
-            sqls.append(self._orderstr)
-        if self._groupstr:
-            sqls.append(self._groupstr)
-        if self._limitstr:
-            sqls.append(self._limitstr)
-        if lock:
-            sqls.append(lock)
-        sql = ' '.join(sqls)
+            results = db.select_parallel(queries)
+        if count:
+            return [{'COUNT(*)': sum([rows[0]['COUNT(*)']
+                                      for rows in results])}]
+        data = []
+        for rows in results:
+            data.extend(rows)
+        if self._order:
+            key, desc = self._order
+            data.sort(key=lambda row: row[key], reverse=bool(desc))
+        if self._limit:
+            offset, ndata = self._limit
+            data = data[offset:offset + ndata]
+        return data
+
+    def explain(self):
+        """EXPLAIN the query getall() would run.
+        @return list of plan rows, dicts of id, select_type, table, type,
+                possible_keys (list), key, key_len, ref, rows, filtered
+                and extra (list)
+        """
+        sql, args, envs = self._gen_sql()
+        try:
+            return _explain(sql, args, envs)
+        except db.DbError:
+            raise ReadError()
+
+    def _mirrored(self, lock, fields, funcs):
+        """Whether Model.mirror can answer the read.  Reads in a
+        transaction go to MySQL so the mirror never holds uncommitted rows.
+        """
+        if (self._model.mirror is None or lock or fields or funcs or
+                self._joins or self._group or self._time_interval or
+                self._seek or self._bucket or db.in_transaction()):
+            return False
+        for name, op, nvalue in self._filts:
+            if op not in ('', 'in'):
+                return False
+        return True
+
+    def _read_mirror(self, count):
+        rows = self._model.mirror.select(self._model, self._filts,
+                                         self._filtargs)
+        if rows is None:
+            return None
+        if count:
+            return [{'COUNT(*)': len(rows)}]
+        if self._order:
+            key, desc = self._order
+            rows.sort(key=lambda row: row[key], reverse=bool(desc))
+        if self._limit:
+            offset, ndata = self._limit
+            rows = rows[offset:offset + ndata]
+        if self._records:
+            return rows
+        return [row._asdict() for row in rows]
+
+    def _locked_partitions(self, lock, count, fields, funcs):
+        """Loader of a locked read of several partitions.  FOR UPDATE
+        of their UNION ALL would lock no row, so each partition is read
+        and locked in its own query, one after the other on the
+        connection of the transaction.  With a limit, rows of each
+        partition up to offset + limit are locked.
+        """
+        if (funcs or self._group or self._time_interval or self._seek or
+                self._bucket):
+            raise FilterInputError('locked read of several partitions '
+                                   'cannot group or aggregate')
+        if self._order and fields and self._order[0] not in fields:
+            raise FilterInputError('locked read of several partitions '
+                                   'must select its order field')
+        tables = self._partitions()
+
+        def load(sql, args, envs):
+            return self._select_partitions(tables, count, fields, lock)
+        return load
+
+    def _read(self, lock=None, count=False, fields=None, funcs=None):
+        if self._mirrored(lock, fields, funcs):
+            try:
+                data = self._read_mirror(count)
+            except db.DbError:
+                raise ReadError()
+            if data is not None:
+                self._data = data
+                if self._prefetches and not count:
+                    self._load_prefetches(self._data)
+                return
+        sql, args, envs = self._gen_sql(lock, count, fields, funcs)
+        load = self._select_records if self._records else db.select
+        if lock and len(self._partitions() or ()) > 1:
+            load = self._locked_partitions(lock, count, fields, funcs)
+        elif not (lock or funcs or self._group or self._time_interval or
+                self._seek or self._bucket or db.in_transaction()):
+            split = self._split_in()
+            tables = self._partitions()
+            if self._order and fields and self._order[0] not in fields:
+                # merged rows could not be sorted
+                split = tables = None
+            if tables and len(tables) > 1:
+                def load(sql, args, envs):
+                    return self._select_partitions(tables, count, fields)
+            elif split:
+                def load(sql, args, envs):
+                    return self._select_chunks(split, count, fields)
+        try:
+            if scan_check is not None:
+                scan_check.check(sql, args, envs)
+            if self._cached and not (lock or db.in_transaction()):
+                self._data = cache.query_cache.fetch(self._tables(), sql,
+                                                     args, envs, load)
+            else:
+                self._data = load(sql, args, envs)
+        except db.DbError:
+            raise ReadError()
+        if self._prefetches and not count:
+            self._load_prefetches(self._data)
+
+    def iter(self, batch_size=1000):
+        """Yield rows one by one without loading the whole result,
+        see db.iter_select.  The rows hold a pooled connection until the
+        iteration ends: reads made meanwhile wait nested_timeout at most
+        for another one, and raise ReadError when the pool stays full.
+        """
+        sql, args, envs = self._gen_sql()
+        rows = db.iter_select(sql, args, batch_size, envs)
         try:
-            self._data = db.select(sql, args, envs)
+            for row in rows:
+                yield row
         except db.DbError:
             raise ReadError()
+        finally:
+            rows.close()
 
     def delete(self):
-        sqls = []
-        sqls.append('DELETE')
-        sqls.append('FROM')
-        sqls.append('`'+self._model.table+'`')
-        filts = self._filts
-        args = self._filtargs
-        filtstr = ' AND '.join(filts)
-        if filtstr:
-            sqls.append('WHERE')
-            sqls.append(filtstr)
-        sql = ' '.join(sqls)
+        deleted = 0
         try:
-            return db.delete(sql, args)
+            for table in self._write_tables():
+                shape = (table, tuple(self._filts))
+                sql = sql_cache.get(('DELETE', shape), _compile_delete, shape)
+                deleted = deleted + db.delete(sql, self._filtargs)
+            return deleted
         except db.DbError:
             raise DeleteError()
+        finally:
+            _invalidate(self._model.table)
 
-    def count(self):
-        self._read(count=True)
-        cnt = self._data[0]['COUNT(*)']
-        self._data = None
+    def _estimate(self):
+        """Row estimate of information_schema without filters, else of
+        the EXPLAIN plan.
+        """
+        if not (self._filts or self._joins or self._time_interval):
+            # rows of a partitioned model are in its partitions
+            tables = self._partitions() or [self._model.table]
+            row = db.select_one(_table_rows_sql %
+                                ','.join(['%s'] * len(tables)), tables)
+            if row and row['TABLE_ROWS'] is not None:
+                return int(row['TABLE_ROWS'])
+        sql, args, envs = self._gen_sql()
+        plan = _explain(sql, args, envs)
+        if not plan or plan[0]['rows'] is None:
+            return 0
+        filtered = plan[0]['filtered']
+        if filtered is None:
+            filtered = 100
+        return int(plan[0]['rows'] * float(filtered) / 100)
+
+    def count(self, approximate=False, ttl=None):
+        """Number of rows matching the filters.
+        @param approximate: estimate it from information_schema or
+                            EXPLAIN instead of COUNT(*), good enough for
+                            pagination totals of big tables
+        @param ttl: keep the count for ttl seconds, or until the table
+                    is written; ignored in a transaction
+        """
+        if db.in_transaction():
+            ttl = None
+        if ttl:
+            sql, args, envs = self._gen_sql(count=True)
+            key = (cache.query_cache.versions(self._tables()), approximate,
+                   repr((sql, args, envs)))
+            cnt = _count_cache.get(key)
+            if cnt is not None:
+                return cnt
+        if approximate:
+            try:
+                cnt = self._estimate()
+            except db.DbError:
+                raise ReadError()
+        else:
+            self._read(count=True)
+            cnt = self._data[0]['COUNT(*)']
+            self._data = None
+        if ttl:
+            _count_cache.set(key, cnt, ttl)
         return cnt
 
     def output(self, *args, **kw):
@@ -278,12 +1078,104 @@ class ModelData():
             self._read(fields=args, funcs=kw)
         return self._data
 
+    def columns(self, *fields):
+        """Read fields (all by default) into one column per field,
+        filled from a streamed tuple cursor without building a dict per
+        row.  Columns are NumPy arrays, or array.array when NumPy is not
+        installed, typed after the Field: int64 for IntField, float64
+        (NULL as nan) for FloatField, int64 in units of 10**-deci for
+        MoneyField, datetime64 for DateTimeField and DateField (integer
+        microseconds/days since the epoch without NumPy).  Other fields
+        give object arrays or lists.
+        @return dict of field name to column
+        """
+        if not fields:
+            fields = sorted(self._model.fields)
+        fds = []
+        for name in fields:
+            if name not in self._model.fields:
+                raise NoFieldError(name)
+            fds.append(self._model.fields[name])
+        cols = [array.array(fd.column_type) if fd.column_type else []
+                for fd in fds]
+        fills = zip([col.append for col in cols],
+                    [fd.to_column for fd in fds])
+        sql, args, envs = self._gen_sql(fields=fields)
+        rows = db.iter_select(sql, args, 1000, envs, db.SSCursor)
+        try:
+            for row in rows:
+                for (append, convert), val in zip(fills, row):
+                    append(convert(val))
+        except db.DbError:
+            raise ReadError()
+        except _field.FieldError, e:
+            raise ReadError(str(e))
+        finally:
+            rows.close()
+        result = {}
+        for name, fd, col in zip(fields, fds, cols):
+            if numpy is None:
+                result[name] = col
+            elif fd.column_type:
+                if col:
+                    col = numpy.frombuffer(col, col.typecode)
+                else:
+                    col = numpy.empty(0, col.typecode)
+                result[name] = col.view(fd.column_dtype)
+            else:
+                result[name] = numpy.array(col, dtype=object)
+        return result
+
     def get(self, ndata, offset=0):
         self.limit(ndata, offset)
         self._read()
         data, self._data = self._data, None
         return data
 
+    def page_after(self, token=None, ndata=20):
+        """Keyset pagination on the orderby field, with Model.pkey as
+        tie-breaker when it is another field.  Each page costs the same
+        as the first one, unlike get(ndata, offset).
+        Model.pkey must be set, rows tied on the orderby field would be
+        skipped at page boundaries otherwise.
+        @param token: None for the first page, else the token returned
+                      with the previous page
+        @return (rows, token of the next page or None at the end)
+        """
+        if not self._order:
+            raise FilterInputError('page_after needs orderby')
+        name, desc = self._order
+        if not self._model.pkey:
+            raise FilterInputError('page_after needs Model.pkey')
+        keys = [name]
+        if self._model.pkey != name:
+            keys.append(self._model.pkey)
+        values = None
+        if token:
+            try:
+                tkeys, values = json.loads(base64.urlsafe_b64decode(
+                    str(token)))
+            except (TypeError, ValueError):
+                raise FilterInputError('bad page token')
+            if tkeys != keys or len(values) != len(keys):
+                raise FilterInputError('bad page token')
+        self._seek = (tuple(keys), desc, values is not None)
+        self._seekargs = _seek_args(values) if values else []
+        self.limit(ndata, 0)
+        try:
+            self._read()
+        finally:
+            self._seek = None
+            self._seekargs = []
+        data, self._data = self._data, None
+        if len(data) < ndata:
+            return data, None
+        last = data[-1]
+        values = [last[key] for key in keys]
+        token = base64.urlsafe_b64encode(json.dumps([keys, values],
+                                                    default=str))
+        return data, token
+
     def getall(self, *args, **kw):
         return self.output(*args, **kw)
 
@@ -312,9 +1204,44 @@ class ModelData():
         return data[0]
 
 
+_plans = {}
+
+
+def _check_plan(model):
+    """Return {field name: check function} of model, built once per
+    class so validating a row only does dict lookups and calls.
+    """
+    plan = _plans.get(model)
+    if plan is None:
+        plan = dict([(name, fld.check)
+                     for name, fld in model.fields.iteritems()])
+        plan = _plans.setdefault(model, plan)
+    return plan
+
+
 class Model():
     table = ''
     fields = {}
+    # read through cache.query_cache by default, see ModelData.cached
+    cached = False
+    # return record.Record rows by default, see ModelData.records
+    records = False
+    # unique field, tie-breaker of ModelData.page_after
+    pkey = None
+    # IN filters of more distinct values than this are split and read
+    # concurrently; ordered rows of the chunks, or of several partitions,
+    # are merged in Python order, not in the collation of the column
+    in_chunk = 1000
+    # writebehind.WriteBehind queueing the inserts, None to insert at once;
+    # inserts inside a transaction are never queued, they must commit or
+    # roll back with it
+    write_behind = None
+    # partition.Partitioning spreading rows over time partitions, None
+    # for one table
+    partition = None
+    # mirror.Mirror answering equality and IN reads in process, None to
+    # always query MySQL
+    mirror = None
 
     @classmethod
     def data(cls):
@@ -322,28 +1249,129 @@ class Model():
 
     @classmethod
     def check(cls, **kv):
+        plan = _check_plan(cls)
         for key, val in kv.iteritems():
-            if key in cls.fields:
-                cls.fields[key].check(val)
-            else:
+            check = plan.get(key)
+            if check is None:
                 raise NoFieldError(key)
+            check(val)
+
+    @classmethod
+    def check_many(cls, rows):
+        """Check rows one column at a time and collect every error
+        instead of raising the first one.
+        @param rows: iterable of dicts, e.g. a generator
+        @return: [(row index, {field name: FieldError or NoFieldError})]
+                 of the invalid rows, ordered by index, [] if all are valid
+        """
+        plan = _check_plan(cls)
+        # read once per column, a generator would be used up by the first
+        rows = list(rows)
+        errors = {}
+        names = set()
+        for row in rows:
+            names.update(row)
+        for name in names:
+            check = plan.get(name)
+            for i, row in enumerate(rows):
+                if name not in row:
+                    continue
+                if check is None:
+                    errors.setdefault(i, {})[name] = NoFieldError(name)
+                    continue
+                try:
+                    check(row[name])
+                except _field.FieldError, e:
+                    errors.setdefault(i, {})[name] = e
+        return sorted(errors.items())
+
+    @classmethod
+    def check_columns(cls, columns):
+        """Check a batch given as columns with Field.check_column, e.g.
+        before insert_many.
+        @param columns: {field name: numpy array}
+        @return: {field name: bool array, True for the invalid rows}
+        """
+        masks = {}
+        for name, col in columns.iteritems():
+            if name not in cls.fields:
+                raise NoFieldError(name)
+            masks[name] = cls.fields[name].check_column(col)
+        return masks
+
+    @classmethod
+    def _route(cls, row):
+        """Table row is inserted into, its partition if any.
+        """
+        if cls.partition is None:
+            return cls.table
+        try:
+            return cls.partition.route(cls.table, row)
+        except _partition.PartitionError, e:
+            raise InsertError(str(e))
+        except db.DbError:
+            raise InsertError()
 
     @classmethod
     def insert(cls, **kv):
         cls.check(**kv)
+        table = cls._route(kv)
+        if cls.write_behind is not None and not db.in_transaction():
+            try:
+                cls.write_behind.put(table, kv)
+            except writebehind.WriteBehindError:
+                raise InsertError()
+            return
         try:
-            db.insert(cls.table, **kv)
+            db.insert(table, **kv)
         except db.DbError:
             raise InsertError()
+        finally:
+            _invalidate(cls.table)
+
+    @classmethod
+    def insert_many(cls, rows, max_bytes=None, update=None):
+        """Check all rows, then insert them in multi-row statements.
+        See db.insert_many for max_bytes and update.
+        """
+        groups = {}
+        for row in rows:
+            cls.check(**row)
+            groups.setdefault(cls._route(row), []).append(row)
+        affected = 0
+        try:
+            for table, trows in sorted(groups.items()):
+                affected = affected + db.insert_many(table, trows, max_bytes,
+                                                     update)
+            return affected
+        except db.DbError:
+            raise InsertError()
+        finally:
+            _invalidate(cls.table)
 
     @classmethod
     def update(cls, **kv):
         cls.data().update(**kv)
 
     @classmethod
-    def count(cls, **kv):
-        cls.data().count(**kv)
+    def count(cls, approximate=False, ttl=None, **kv):
+        return cls.data().filter(**kv).count(approximate, ttl)
 
     @classmethod
     def delete(cls, **kv):
-        cls.data().delete(**kv)
+        return cls.data().filter(**kv).delete()
+
+    @classmethod
+    def drop_partitions(cls, before):
+        """Drop the partitions older than the period of the date before,
+        much cheaper than deleting their rows.
+        @return names of the dropped tables
+        """
+        if cls.partition is None:
+            raise ModelError('%s is not partitioned' % cls.__name__)
+        try:
+            return cls.partition.drop_before(cls.table, before)
+        except _partition.PartitionError, e:
+            raise FilterInputError(str(e))
+        except db.DbError:
+            raise DeleteError()
@@ -0,0 +1,145 @@
+# coding: utf8
+import re
+import time
+import threading
+
+from ..common import db
+from ..common import cache
+
+
+class PartitionError(Exception):
+    pass
+
+
+_tables_sql = 'SELECT TABLE_NAME FROM information_schema.TABLES ' \
+              'WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME LIKE %s'
+# length of the table suffix per period, YYYYMM or YYYYMMDD
+_periods = {'month': 6, 'day': 8}
+
+
+def _suffix(value, size):
+    """'20261018'[:size] of a date, datetime or 'YYYY-MM-DD...' string.
+    """
+    if hasattr(value, 'year'):
+        parts = (value.year, value.month, value.day)
+    elif isinstance(value, basestring) and len(value) >= 10:
+        try:
+            parts = (int(value[:4]), int(value[5:7]), int(value[8:10]))
+        except ValueError:
+            raise PartitionError('bad date %r' % value)
+    else:
+        raise PartitionError('bad date %r' % (value,))
+    return ('%04d%02d%02d' % parts)[:size]
+
+
+class Partitioning(object):
+    """Rows of a model spread over one table per month or day of a date
+    field, named after the model table: metrics_202610 or
+    metrics_20261018.  Set it as Model.partition.
+    The model table itself stays empty and is the template of the
+    partitions, created with CREATE TABLE ... LIKE on their first insert.
+    Reads only touch the partitions their filters on field can match,
+    and old partitions are dropped whole with drop_before.
+    @param period: 'month' or 'day'
+    @param ttl: seconds the list of partitions is kept before it is read
+                again, partitions created by other processes are seen
+                after it
+    """
+    def __init__(self, field, period='month', ttl=60):
+        if period not in _periods:
+            raise PartitionError('unknown period %s' % period)
+        self.field = field
+        self.period = period
+        self.ttl = ttl
+        self._size = _periods[period]
+        self._lock = threading.Lock()
+        # base table: (expire time, partition names oldest first)
+        self._tables = {}
+
+    def suffix(self, value):
+        return _suffix(value, self._size)
+
+    def tables(self, base):
+        """Existing partitions of base, oldest first.
+        """
+        item = self._tables.get(base)
+        if item is None or item[0] < time.time():
+            pat = re.compile(r'^%s_\d{%d}$' % (re.escape(base), self._size))
+            rows = db.select(_tables_sql, [base.replace('_', r'\_') + r'\_%'])
+            names = sorted([row['TABLE_NAME'] for row in rows
+                            if pat.match(row['TABLE_NAME'])])
+            item = self._tables[base] = (time.time() + self.ttl, names)
+        return item[1]
+
+    def _update(self, base, add=(), remove=()):
+        with self._lock:
+            expire, names = self._tables.get(base, (0, []))
+            names = set(names).union(add).difference(remove)
+            self._tables[base] = (expire, sorted(names))
+        # reads which found no partition, or a dropped one, are stale
+        cache.query_cache.invalidate(base)
+
+    def route(self, base, row):
+        """Return the partition of row, created from base when missing.
+        """
+        if row.get(self.field) is None:
+            raise PartitionError('%s is required' % self.field)
+        table = '%s_%s' % (base, self.suffix(row[self.field]))
+        if table not in self.tables(base):
+            # apart from the insert's transaction, which DDL would commit
+            db.execute_apart('CREATE TABLE IF NOT EXISTS `%s` LIKE `%s`' %
+                             (table, base))
+            self._update(base, add=[table])
+        return table
+
+    def select(self, base, filts, args):
+        """Return the partitions of base which rows matching filts can be
+        in, oldest first.  Filters on field with =, IN, >, >=, < or <=
+        narrow them, other filters are ignored.
+        @param filts: filter shapes (name, op, nvalue) of ModelData
+        @param args: their arguments
+        """
+        keys = None
+        low = high = None
+        offset = 0
+        for name, op, nvalue in filts:
+            values = args[offset:offset + nvalue]
+            offset = offset + nvalue
+            if name != self.field:
+                continue
+            if op in ('', 'in'):
+                found = set([self.suffix(val) for val in values])
+                keys = found if keys is None else keys & found
+            elif op in ('gt', 'ge'):
+                key = self.suffix(values[0])
+                low = key if low is None else max(low, key)
+            elif op in ('lt', 'le'):
+                key = self.suffix(values[0])
+                high = key if high is None else min(high, key)
+        tables = []
+        for table in self.tables(base):
+            key = table[-self._size:]
+            if keys is not None and key not in keys:
+                continue
+            if low is not None and key < low:
+                continue
+            if high is not None and key > high:
+                continue
+            tables.append(table)
+        return tables
+
+    def drop_before(self, base, value):
+        """Drop the partitions of base older than the period of value,
+        apart from the transaction of the caller, which DDL would commit.
+        @return names of the dropped tables
+        """
+        key = self.suffix(value)
+        dropped = []
+        try:
+            for table in self.tables(base):
+                if table[-self._size:] < key:
+                    db.execute_apart('DROP TABLE IF EXISTS `%s`' % table)
+                    dropped.append(table)
+        finally:
+            self._update(base, remove=dropped)
+        return dropped
@@ -0,0 +1,87 @@
+# coding: utf8
+import re
+import operator
+import threading
+
+
+_ident = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_classes = {}
+_lock = threading.Lock()
+
+
+class Record(tuple):
+    """Immutable row keeping its values in a tuple, a few times smaller
+    than the dict of DictCursor.  Values are read by attribute, by column
+    name like a dict, or by index.  Columns which are not identifiers or
+    clash with a method (COUNT(*), count...) only have key access.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __reduce__(self):
+        return (_rebuild, (type(self).__name__, self._fields, tuple(self)))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            ['%s=%r' % item for item in zip(self._fields, self)]))
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def _extend(self, name, value):
+        """Return a record of the same values plus column name.
+        """
+        cls = record_class(type(self).__name__, self._fields + (name,))
+        return cls(tuple(self) + (value,))
+
+
+def record_class(name, fields):
+    """Return the Record subclass of the column names fields, generated
+    once per name and fields.
+    """
+    key = (name, fields)
+    cls = _classes.get(key)
+    if cls is not None:
+        return cls
+    attrs = {
+        '__slots__': (),
+        '_fields': fields,
+        '_index': dict([(field, i) for i, field in enumerate(fields)]),
+    }
+    for i, field in enumerate(fields):
+        if _ident.match(field) and not hasattr(Record, field):
+            attrs[field] = property(operator.itemgetter(i))
+    with _lock:
+        cls = _classes.setdefault(key, type(str(name), (Record,), attrs))
+    return cls
+
+
+def _rebuild(name, fields, values):
+    return record_class(name, fields)(values)
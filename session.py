@@ -1,8 +1,19 @@
 # coding: utf8
+import os
+import json
+import math
+import zlib
 import time
 import random
 import redis
+import marshal
 import cPickle
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 import util
 import const
@@ -28,6 +39,120 @@ class NoDatebaseError(SessionError):
     pass
 
 
+def _pickle_dumps(data):
+    return cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+# codec name: (header id, dumps, loads)
+_codecs = {
+    'pickle': (1, _pickle_dumps, cPickle.loads),
+    'marshal': (2, marshal.dumps, marshal.loads),
+    'json': (3, _json_dumps, json.loads),
+}
+if msgpack is not None:
+    _codecs['msgpack'] = (4, msgpack.packb, msgpack.unpackb)
+_loads = dict([(cid, loads) for cid, dumps, loads in _codecs.values()])
+# header flag of zlib compressed payloads
+_ZLIB = 0x10
+
+
+class Serializer(object):
+    """Encoding of session values: a header byte naming the codec and
+    the compression, then the payload.  Values of any codec are read
+    whatever the codec set, and values without header, the protocol 0
+    pickles written before, are read as pickles.
+    marshal only takes builtin types, json returns unicode strings.
+    @param codec: 'pickle' (binary protocol), 'marshal', 'json' or
+                  'msgpack' when installed
+    @param compress: zlib compress payloads longer than this, None never
+    """
+    def __init__(self, codec='pickle', compress=1024, level=1):
+        if codec not in _codecs:
+            raise SessionError('unknown codec %s' % codec)
+        self._id, self._dumps, loads = _codecs[codec]
+        self._compress = compress
+        self._level = level
+
+    def dumps(self, data):
+        payload = self._dumps(data)
+        header = self._id
+        if self._compress is not None and len(payload) > self._compress:
+            payload = zlib.compress(payload, self._level)
+            header = header | _ZLIB
+        return chr(header) + payload
+
+    def loads(self, value):
+        header = ord(value[0]) if value else 0
+        loads = _loads.get(header & ~_ZLIB)
+        if loads is None:
+            return cPickle.loads(value)
+        payload = value[1:]
+        if header & _ZLIB:
+            payload = zlib.decompress(payload)
+        return loads(payload)
+
+
+# key holding the creation time in stored sessions
+_CTIME = '__ctime__'
+# read the session and slide its expiry in one call, only when ARGV[2]
+# seconds or fewer are left so most reads do not write
+_read_lua = '''
+local value = redis.call('%s', KEYS[1])
+if value and (type(value) ~= 'table' or #value > 0) and
+        redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return value
+'''
+_get_lua = _read_lua % 'GET'
+_hgetall_lua = _read_lua % 'HGETALL'
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _client(host, port, db, password, socket_timeout, max_connections):
+    """StrictRedis on the connection pool shared by the sessions of the
+    same settings, created again in a forked child so processes never
+    share sockets.
+    """
+    key = (host, port, db, password, socket_timeout, max_connections)
+    item = _clients.get(key)
+    if item is None or item[0] != os.getpid():
+        with _lock:
+            item = _clients.get(key)
+            if item is None or item[0] != os.getpid():
+                pool = redis.ConnectionPool(host=host, port=port, db=db,
+                                            password=password,
+                                            socket_timeout=socket_timeout,
+                                            max_connections=max_connections)
+                item = (os.getpid(), redis.StrictRedis(connection_pool=pool))
+                _clients[key] = item
+    return item[1]
+
+
+def pool_stats():
+    """Return {'host:port/db': {created, in_use, idle, max}} of the
+    connection pools of this process.
+    """
+    stats = {}
+    for key, (pid, client) in _clients.items():
+        if pid != os.getpid():
+            continue
+        pool = client.connection_pool
+        stats['%s:%s/%s' % key[:3]] = {
+            'created': getattr(pool, '_created_connections', 0),
+            'in_use': len(getattr(pool, '_in_use_connections', ())),
+            'idle': len(getattr(pool, '_available_connections', ())),
+            'max': pool.max_connections,
+        }
+    return stats
+
+
 def _create_sid(ipaddr):
     if not ipaddr:
         ipaddr = '.'.join([str(random.randint(0, 256)) for x in range(0, 4)])
@@ -36,6 +161,13 @@ def _create_sid(ipaddr):
 
 class RedisSession(object):
     """Session whose data is stored in Redis.
+    Only keys changed through __setitem__, __delitem__, update and clear
+    are written, save does nothing when none was.  Values changed in
+    place, or through data, must be set again to be saved.
+    Sessions expire ttl seconds after their last use, and max_age
+    seconds after their creation whatever their use.  The expiry is
+    slid by the read itself, and only once a refresh fraction of ttl
+    has passed since the last time.
     """
     def __init__(self, sid=None,
                  ipaddr=None,
@@ -43,8 +175,16 @@ class RedisSession(object):
                  port=6379,
                  db=0,
                  password=None,
-                 socket_timeout=None):
+                 socket_timeout=None,
+                 max_connections=None,
+                 layout='blob',
+                 codec='pickle',
+                 compress=1024,
+                 ttl=None,
+                 max_age=None,
+                 refresh=0.1):
         """Initial redis.  Generate sid if sid is None.
+        Sessions of the same redis settings share one connection pool.
         @param sid: sid
         @param ipaddr: remote addr used to generate sid
         @param host: redis host addr
@@ -52,25 +192,92 @@ class RedisSession(object):
         @param db: redis db
         @param password: redis password
         @param socket_timeout: redis timeout
+        @param max_connections: size limit of the pool, None for no limit
+        @param layout: 'blob' stores the data as one value, 'hash' each
+                       key as a field of a Redis hash so a save only
+                       writes the changed keys
+        @param codec, compress: see Serializer
+        @param ttl: seconds an unused session lives, None for ever
+        @param max_age: seconds a session lives at most, None for ever
+        @param refresh: fraction of ttl passed before the expiry is slid
         """
+        if layout not in ('blob', 'hash'):
+            raise OpenError('unknown layout %s' % layout)
         try:
-            self._redis = redis.StrictRedis(host=host, port=port, db=db,
-                                            password=password,
-                                            socket_timeout=socket_timeout)
+            self._redis = _client(host, port, db, password, socket_timeout,
+                                  max_connections)
         except redis.RedisError:
             raise OpenError()
+        self._layout = layout
+        try:
+            self._serializer = Serializer(codec, compress)
+        except SessionError:
+            raise OpenError('unknown codec %s' % codec)
+        self._ttl = ttl
+        self._max_age = max_age
+        self._refresh = refresh
+        self._ctime = time.time()
         self._data = None
+        # keys set or deleted since the last save
+        self._changed = set()
+        # the whole data must be written, for new and cleared sessions
+        self._rewrite = False
         if sid:
             self._sid = sid
             try:
-                data = self._redis.get(sid)
+                self._data = self._load(sid)
             except redis.RedisError:
                 raise ReadError()
-            if data is not None:
-                self._data = cPickle.loads(data)
         if self._data is None:
             self._sid = _create_sid(ipaddr)
+            self._ctime = time.time()
             self._data = {}
+            self._rewrite = True
+
+    def _read(self, sid):
+        hashed = self._layout == 'hash'
+        if not self._ttl:
+            if hashed:
+                return self._redis.hgetall(sid)
+            return self._redis.get(sid)
+        script = self._redis.register_script(_hgetall_lua if hashed
+                                             else _get_lua)
+        left = self._ttl - int(self._ttl * self._refresh)
+        value = script(keys=[sid], args=[self._ttl, left])
+        if hashed:
+            return dict(zip(value[::2], value[1::2]))
+        return value
+
+    def _load(self, sid):
+        value = self._read(sid)
+        if not value:
+            return None
+        if self._layout == 'hash':
+            data = dict([(key, self._serializer.loads(val))
+                         for key, val in value.iteritems()])
+        else:
+            data = self._serializer.loads(value)
+        ctime = data.pop(_CTIME, None)
+        if ctime is None:
+            # written before the creation time was kept
+            self._rewrite = bool(self._max_age)
+        else:
+            if self._max_age and ctime + self._max_age <= time.time():
+                return None
+            self._ctime = ctime
+        return data
+
+    def _expiry(self):
+        """Seconds the stored session lives from now, None for ever.
+        """
+        ttls = []
+        if self._ttl:
+            ttls.append(self._ttl)
+        if self._max_age:
+            ttls.append(self._ctime + self._max_age - time.time())
+        if not ttls:
+            return None
+        return max(int(math.ceil(min(ttls))), 1)
 
     @property
     def data(self):
@@ -80,25 +287,71 @@ class RedisSession(object):
     def sid(self):
         return self._sid
 
+    @property
+    def dirty(self):
+        return self._rewrite or bool(self._changed)
+
+    def _save_hash(self):
+        pipe = self._redis.pipeline()
+        if self._rewrite:
+            pipe.delete(self._sid)
+            keys = self._data.keys()
+            pipe.hset(self._sid, _CTIME, self._serializer.dumps(self._ctime))
+        else:
+            keys = [key for key in self._changed if key in self._data]
+            removed = [key for key in self._changed if key not in self._data]
+            if removed:
+                pipe.hdel(self._sid, *removed)
+        if keys:
+            dumps = self._serializer.dumps
+            pipe.hmset(self._sid, dict([(key, dumps(self._data[key]))
+                                        for key in keys]))
+        expiry = self._expiry()
+        if expiry:
+            pipe.expire(self._sid, expiry)
+        pipe.execute()
+
     def save(self):
+        """Write the changes since the last save, if any.
+        """
+        if not self.dirty:
+            return
         try:
-            self._redis.set(self._sid, cPickle.dumps(self._data))
+            if self._layout == 'hash':
+                self._save_hash()
+            else:
+                data = dict(self._data)
+                data[_CTIME] = self._ctime
+                self._redis.set(self._sid, self._serializer.dumps(data),
+                                ex=self._expiry())
         except redis.RedisError:
             raise WriteError()
+        self._changed = set()
+        self._rewrite = False
 
     def update(self, **data):
         self._data.update(data)
+        self._changed.update(data)
         self.save()
 
     def clear(self):
         self._data = {}
+        self._changed = set()
+        self._rewrite = True
         self.save()
 
     def get(self, key):
         return self._data.get(key)
 
     def __setitem__(self, key, val):
+        # no comparison with the old value, it may be the same object
+        # changed in place
         self._data[key] = val
+        self._changed.add(key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._changed.add(key)
 
 
 def create_session(db, **data):
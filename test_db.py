@@ -0,0 +1,154 @@
+# coding: utf8
+"""Read routing of db against a stand-in driver, passed to the pools
+with connect=.  Run from the application root:
+    python -m unittest <app>.common.test_db
+"""
+import unittest
+
+import MySQLdb
+
+from ..common import db
+
+
+class _Cursor(object):
+
+    def __init__(self, server):
+        self._server = server
+        self._rows = []
+        self.rowcount = 0
+        self.description = None
+
+    def execute(self, sql, args=None):
+        self._server.log.append((self._server.host, sql))
+        if self._server.error is not None:
+            raise self._server.error
+        self._rows = [{'host': self._server.host}]
+        self.rowcount = 1
+        self.description = (('host',),)
+        return 1
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def close(self):
+        pass
+
+
+class _Connection(object):
+
+    def __init__(self, server):
+        self._server = server
+
+    def autocommit(self, on):
+        pass
+
+    def cursor(self, cursorclass=None):
+        return _Cursor(self._server)
+
+    def ping(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self._server.closed = self._server.closed + 1
+
+    def insert_id(self):
+        return 0
+
+    def literal(self, val):
+        return repr(val)
+
+
+class _Server(object):
+    """A MySQL server of the stand-in driver.
+    @ivar error: raised by every statement when set
+    @ivar refuse: connections are refused when set
+    """
+    def __init__(self, host, log):
+        self.host = host
+        self.log = log
+        self.error = None
+        self.refuse = False
+        self.closed = 0
+
+    def connect(self, **params):
+        if self.refuse:
+            raise MySQLdb.OperationalError(2003, "Can't connect")
+        return _Connection(self)
+
+
+class ReadRoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.primary = _Server('primary', self.log)
+        self.replica = _Server('replica', self.log)
+        self._saved = db._pool, db._router
+        db._pool = db.ConnectionPool({'host': 'primary'},
+                                     connect=self.primary.connect)
+        rep = db.Replica({'host': 'replica'},
+                         pool_conf={'connect': self.replica.connect})
+        db._router = db.ReplicaRouter([rep])
+        self.rep = rep
+
+    def tearDown(self):
+        db._pool, db._router = self._saved
+
+    def host(self):
+        return db.select('SELECT 1', [])[0]['host']
+
+    def test_read_from_replica(self):
+        self.assertEqual(self.host(), 'replica')
+        self.assertEqual(self.rep.reads, 1)
+
+    def test_locked_read_on_primary(self):
+        rows = db.select('SELECT 1 FOR UPDATE', [])
+        self.assertEqual(rows[0]['host'], 'primary')
+
+    def test_transaction_reads_primary(self):
+        @db.with_transaction
+        def read():
+            return self.host()
+        self.assertEqual(read(), 'primary')
+
+    def test_write_sticks_to_primary(self):
+        db.update('t', None, a=1)
+        self.assertEqual(self.log[-1][0], 'primary')
+        self.assertEqual(self.host(), 'primary')
+        db.end_request()
+        self.assertEqual(self.host(), 'replica')
+
+    def test_lost_replica_ejected(self):
+        self.replica.error = MySQLdb.OperationalError(2013, 'Lost')
+        self.assertEqual(self.host(), 'primary')
+        self.assertEqual(self.rep.ejections, 1)
+        # the broken connection is dropped, not kept idle
+        self.assertEqual(self.replica.closed, 1)
+        self.assertEqual(self.rep.pool.stats()['total'], 0)
+        self.replica.error = None
+        self.assertEqual(self.host(), 'primary')
+
+    def test_refused_replica_ejected(self):
+        self.replica.refuse = True
+        self.assertEqual(self.host(), 'primary')
+        self.assertEqual(self.rep.ejections, 1)
+
+    def test_query_error_raised(self):
+        self.replica.error = MySQLdb.OperationalError(1054, 'Unknown column')
+        self.assertRaises(MySQLdb.OperationalError, self.host)
+        self.assertEqual(self.rep.ejections, 0)
+        self.assertEqual(self.rep.pool.stats()['idle'], 1)
+        self.assertEqual([host for host, sql in self.log], ['replica'])
+
+
+if __name__ == '__main__':
+    unittest.main()
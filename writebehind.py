@@ -0,0 +1,183 @@
+# coding: utf8
+import os
+import time
+import Queue
+import atexit
+import logging
+import threading
+
+from ..common import db
+from ..common import cache
+
+
+_log = logging.getLogger(__name__)
+_queues = []
+_stop = object()
+
+
+class WriteBehindError(Exception):
+    pass
+
+
+class QueueFullError(WriteBehindError):
+    pass
+
+
+class _Flush(object):
+    """Marker asking the writer to flush what it holds.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class WriteBehind(object):
+    """Bounded queue of rows inserted by a background thread with
+    db.insert_many, once batch rows are queued or interval seconds after
+    the first one.  Set it as Model.write_behind to queue the model's
+    inserts; one queue can serve several models.
+    Rows still queued are flushed at exit.  Rows of a failed flush are
+    logged and dropped.
+    @param maxsize: rows queued at most, put blocks while it is full
+    @param timeout: seconds put blocks before QueueFullError, None for
+                    ever
+    """
+    def __init__(self, batch=500, interval=1.0, maxsize=10000, timeout=None):
+        self.batch = batch
+        self.interval = interval
+        self.timeout = timeout
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._queued = 0
+        self._blocked = 0
+        self._flushes = 0
+        self._flushed = 0
+        self._flush_time = 0.0
+        self._max_flush_time = 0.0
+        self._errors = 0
+        self._dropped = 0
+        _queues.append(self)
+
+    def _start(self):
+        """Start the writer, again in a forked child whose queue and
+        thread are the parent's.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self._maxsize)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def put(self, table, row):
+        if self._pid != os.getpid():
+            self._start()
+        item = (table, row)
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            self._blocked = self._blocked + 1
+            try:
+                self._queue.put(item, True, self.timeout)
+            except Queue.Full:
+                raise QueueFullError(table)
+        self._queued = self._queued + 1
+
+    def _take(self):
+        items = []
+        item = self._queue.get()
+        deadline = time.time() + self.interval
+        while True:
+            if isinstance(item, _Flush) or item is _stop:
+                return items, item
+            items.append(item)
+            if len(items) >= self.batch:
+                return items, None
+            remain = deadline - time.time()
+            if remain <= 0:
+                return items, None
+            try:
+                item = self._queue.get(True, remain)
+            except Queue.Empty:
+                return items, None
+
+    def _run(self):
+        while True:
+            items, marker = self._take()
+            if items:
+                self._write(items)
+            if isinstance(marker, _Flush):
+                marker.done.set()
+            elif marker is _stop:
+                return
+
+    def _write(self, items):
+        groups = {}
+        order = []
+        for table, row in items:
+            key = (table, tuple(sorted(row)))
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(row)
+        begin = time.time()
+        for key in order:
+            table, rows = key[0], groups[key]
+            try:
+                db.insert_many(table, rows)
+                self._flushed = self._flushed + len(rows)
+            except Exception:
+                _log.exception('write behind of %d rows into %s failed',
+                               len(rows), table)
+                self._errors = self._errors + 1
+                self._dropped = self._dropped + len(rows)
+            finally:
+                cache.query_cache.invalidate(table)
+        elapsed = time.time() - begin
+        self._flushes = self._flushes + 1
+        self._flush_time = self._flush_time + elapsed
+        self._max_flush_time = max(self._max_flush_time, elapsed)
+
+    def flush(self, timeout=None):
+        """Insert the queued rows now and wait for it.
+        """
+        if self._pid != os.getpid():
+            return
+        marker = _Flush()
+        self._queue.put(marker)
+        marker.done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Flush the queued rows and stop the writer.
+        """
+        if self._pid != os.getpid():
+            return
+        self._queue.put(_stop)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self):
+        return {
+            'depth': self._queue.qsize() if self._pid == os.getpid() else 0,
+            'queued': self._queued,
+            'blocked': self._blocked,
+            'flushes': self._flushes,
+            'flushed': self._flushed,
+            'flush_time': self._flush_time,
+            'max_flush_time': self._max_flush_time,
+            'errors': self._errors,
+            'dropped': self._dropped,
+        }
+
+
+def close_all():
+    """Flush and stop every WriteBehind, registered with atexit.
+    """
+    for queue in _queues:
+        queue.close()
+
+
+atexit.register(close_all)